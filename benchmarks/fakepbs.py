@@ -0,0 +1,163 @@
+#!/usr/bin/env python2
+import os
+import re
+import sys
+import time
+import json
+import fcntl
+import getpass
+import argparse
+
+# Stand-ins for qsub/qstat/qdel backed by a JSON job table. Jobs are not executed:
+# a job stays queued for --queue-time seconds after submission, runs for --run-time
+# seconds and then finishes with exit status 0. Deleted jobs finish with the exit
+# status PBS Pro reports for them.
+DELETED_EXIT_STATUS = 271
+SERVER = "fakepbs"
+
+
+class FakePBS:
+    def __init__(self, table_dir):
+        self.table_path = os.path.join(table_dir, "jobs.json")
+        self.lock_path = os.path.join(table_dir, "lock")
+        if not os.path.exists(table_dir):
+            os.makedirs(table_dir)
+        self._lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            with open(self.table_path, 'r') as table_file:
+                self.table = json.load(table_file)
+        except IOError:
+            self.table = {"next-id": 1000, "jobs": {}}
+
+    def save(self):
+        tmp_path = self.table_path + ".tmp"
+        with open(tmp_path, 'w') as table_file:
+            json.dump(self.table, table_file)
+        os.rename(tmp_path, self.table_path)
+
+    def state(self, job):
+        now = time.time()
+        if job["deleted"] is not None:
+            return "F", DELETED_EXIT_STATUS
+        if now < job["submitted"] + job["queue-time"]:
+            return "Q", None
+        if now < job["submitted"] + job["queue-time"] + job["run-time"]:
+            return "R", None
+        return "F", 0
+
+    def qsub(self, script, array, queue_time, run_time):
+        if not os.path.exists(script):
+            sys.exit("qsub: script file:: No such file or directory")
+        job_id = str(self.table["next-id"])
+        self.table["next-id"] += 1
+        elements = None
+        if array is not None:
+            first, last = [int(i) for i in array.split("-")]
+            elements = range(first, last + 1)
+            job_id += "[]"
+        self.table["jobs"][job_id] = {"name": os.path.basename(script)[:15],
+                                      "user": getpass.getuser(),
+                                      "submitted": time.time(),
+                                      "queue-time": queue_time,
+                                      "run-time": run_time,
+                                      "deleted": None,
+                                      "elements": elements}
+        self.save()
+        return "%s.%s" % (job_id, SERVER)
+
+    def _entries(self, expand_arrays):
+        for job_id, job in sorted(self.table["jobs"].items()):
+            if job["elements"] is not None and expand_arrays:
+                for i in job["elements"]:
+                    yield job_id.replace("[]", "[%d]" % i), job
+            else:
+                yield job_id, job
+
+    def _selected(self, job_ids):
+        return set([job_id.split(".")[0] for job_id in job_ids])
+
+    def qstat(self, job_ids, expand_arrays, history):
+        selected = self._selected(job_ids)
+        lines = ["Job id            Name             User              Time Use S Queue",
+                 "----------------  ---------------- ----------------  -------- - -----"]
+        for job_id, job in self._entries(expand_arrays):
+            if selected and job_id not in selected and job_id.split("[")[0] + "[]" not in selected:
+                continue
+            state, exit_status = self.state(job)
+            if state == "F" and not history:
+                continue
+            lines.append("%-17s %-16s %-16s  %8s %s %s" % ("%s.%s" % (job_id, SERVER), job["name"],
+                                                           job["user"], "00:00:00", state, "workq"))
+        return lines
+
+    def qstat_json(self, job_ids, expand_arrays, history):
+        selected = self._selected(job_ids)
+        jobs = {}
+        for job_id, job in self._entries(expand_arrays):
+            if selected and job_id not in selected and job_id.split("[")[0] + "[]" not in selected:
+                continue
+            state, exit_status = self.state(job)
+            if state == "F" and not history:
+                continue
+            entry = {"Job_Name": job["name"], "job_state": state}
+            if exit_status is not None:
+                entry["Exit_status"] = exit_status
+            jobs["%s.%s" % (job_id, SERVER)] = entry
+        return json.dumps({"pbs_server": SERVER, "Jobs": jobs}, indent=4)
+
+    def qdel(self, job_ids):
+        unknown = []
+        for job_id in job_ids:
+            job_id = job_id.split(".")[0]
+            # Array elements are deleted with their whole array
+            parent_id = re.sub(r"\[\d+\]$", "[]", job_id)
+            job = self.table["jobs"].get(parent_id)
+            if job is None or self.state(job)[0] == "F":
+                unknown.append(job_id)
+            else:
+                job["deleted"] = time.time()
+        self.save()
+        return unknown
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Fake PBS commands backed by a local job table.")
+    parser.add_argument('-d', '--table-dir', type=str, required=True, help="Directory of the job table.")
+    subparsers = parser.add_subparsers()
+    parser_qsub = subparsers.add_parser('qsub')
+    parser_qsub.set_defaults(command="qsub")
+    parser_qsub.add_argument('-J', type=str, dest="array", help="Array range 'first-last'.")
+    parser_qsub.add_argument('--queue-time', type=float, default=0.0, help="Seconds queued.")
+    parser_qsub.add_argument('--run-time', type=float, default=10.0, help="Seconds running.")
+    parser_qsub.add_argument('script', type=str)
+    parser_qstat = subparsers.add_parser('qstat')
+    parser_qstat.set_defaults(command="qstat")
+    parser_qstat.add_argument('-t', action="store_true", help="Expand array jobs.")
+    parser_qstat.add_argument('-x', action="store_true", help="Include finished jobs.")
+    parser_qstat.add_argument('-f', action="store_true", help="Full output.")
+    parser_qstat.add_argument('-F', type=str, help="Output format.")
+    parser_qstat.add_argument('job_ids', type=str, nargs='*')
+    parser_qdel = subparsers.add_parser('qdel')
+    parser_qdel.set_defaults(command="qdel")
+    parser_qdel.add_argument('job_ids', type=str, nargs='+')
+    args = parser.parse_args(args)
+
+    pbs = FakePBS(args.table_dir)
+    if args.command == "qsub":
+        print(pbs.qsub(args.script, args.array, args.queue_time, args.run_time))
+    elif args.command == "qstat":
+        if args.F == "json":
+            print(pbs.qstat_json(args.job_ids, args.t, args.x))
+        else:
+            print("\n".join(pbs.qstat(args.job_ids, args.t, args.x)))
+    elif args.command == "qdel":
+        unknown = pbs.qdel(args.job_ids)
+        for job_id in unknown:
+            sys.stderr.write("qdel: Unknown Job Id %s\n" % job_id)
+        if unknown:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
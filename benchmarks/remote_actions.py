@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+# Latency and throughput of upload, job-submit, job-status, job-delete and download
+# against a loopback remote: commands and transfers run on this machine and the
+# scheduler is replaced by the fake PBS commands of 'fakepbs.py'.
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "paramate"))
+
+import remote
+from study import Study, StudyGenerator
+from common import _printer
+
+FAKEPBS = os.path.join(BENCH_DIR, "fakepbs.py")
+STUDY_NAME = "bench"
+REMOTE_NAME = "loopback"
+PARAMS_YAML = """STUDY:
+    name: bench
+PARAMS-MULTIVAL:
+    name: i
+    values: [0]
+FILES:
+    - path: input
+      files: []
+"""
+SUBMIT_SCRIPT = """#!/bin/bash
+#PBS -N $[PARAMATE-CN]
+cd $[PARAMATE-RWD]/$[PARAMATE-SN]/$[PARAMATE-CN]
+bash exec.sh
+"""
+
+
+# Cases are added directly instead of generated, so only the remote actions are measured
+def create_study(path, nof_cases, case_size):
+    study_path = os.path.join(path, STUDY_NAME)
+    for directory in StudyGenerator.DEFAULT_DIRECTORIES:
+        os.makedirs(os.path.join(study_path, directory))
+    files = {"params.yaml": PARAMS_YAML,
+             "submit.%s.sh" % REMOTE_NAME: SUBMIT_SCRIPT,
+             "template/exec.sh": "sleep 1\n"}
+    for f in set(StudyGenerator.DEFAULT_FILES + ["cases.info", "postproc.py", "upload"] + files.keys()):
+        with open(os.path.join(study_path, f), 'w') as study_file:
+            study_file.write(files.get(f, ""))
+    study = Study(STUDY_NAME, study_path)
+    study.params = ["i"]
+    nof_figures = len(str(nof_cases - 1))
+    for i in range(nof_cases):
+        case_name = "%0*d_i-%d" % (nof_figures, i, i)
+        shutil.copytree(os.path.join(study_path, "template"), os.path.join(study_path, case_name))
+        with open(os.path.join(study_path, case_name, "output", "data.bin"), 'wb') as data_file:
+            data_file.write(os.urandom(case_size))
+        study.add_case(case_name, {"i": i})
+    study.save()
+    study.load()
+    return study
+
+
+def loopback_remote(workdir, table_dir, queue_time, run_time):
+    r = remote.LocalRemote(name=REMOTE_NAME, workdir=workdir, resource_manager="pbs")
+    fakepbs = "%s %s -d %s" % (sys.executable, FAKEPBS, table_dir)
+    r.jobs_commands = {"submit": "%s qsub --queue-time %g --run-time %g" % (fakepbs, queue_time, run_time),
+                       "status": fakepbs + " qstat",
+                       "delete": fakepbs + " qdel"}
+    os.makedirs(workdir)
+    r.connect()
+    return r
+
+
+def run(nof_cases, args):
+    tmpdir = tempfile.mkdtemp(prefix="paramate-bench-")
+    results = []
+    try:
+        study = create_study(tmpdir, nof_cases, args.case_size)
+        r = loopback_remote(os.path.join(tmpdir, "remote"), os.path.join(tmpdir, "fakepbs"),
+                            args.queue_time, args.run_time)
+        sm = remote.StudyManager(study)
+        sm.tmpdir = tmpdir
+        nbytes = nof_cases * args.case_size
+
+        def timed(action, func, transferred=0):
+            start = time.time()
+            func()
+            results.append((action, nof_cases, time.time() - start, transferred))
+
+        timed("upload", lambda: sm.upload(r, array_job=args.array_job, force=True), nbytes)
+        timed("job-submit", lambda: sm.job_submit(r, array_job=args.array_job))
+        timed("job-status", lambda: sm.job_status(r))
+        timed("job-delete", lambda: sm.job_delete(r))
+        timed("download", lambda: sm.download(r, force=True), nbytes)
+        r.close()
+    finally:
+        if args.keep:
+            _printer.print_msg("Kept '%s'." % tmpdir, ignore_quiet=True)
+        else:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark remote actions against a loopback remote.")
+    parser.add_argument('-n', '--cases', type=int, nargs='+', default=[100, 1000],
+                        help="Number of cases of each run.")
+    parser.add_argument('--case-size', type=int, default=4096, help="Bytes of output data per case.")
+    parser.add_argument('--array-job', action="store_true", help="Upload and submit as an array job.")
+    parser.add_argument('--queue-time', type=float, default=0.0, help="Seconds each job stays queued.")
+    parser.add_argument('--run-time', type=float, default=3600.0, help="Seconds each job runs.")
+    parser.add_argument('--keep', action="store_true", help="Keep the temporary directories.")
+    args = parser.parse_args(args)
+
+    _printer.configure(verbose=False, quiet=True)
+    print("{:<12} {:>8} {:>10} {:>12} {:>10}".format("action", "cases", "seconds", "cases/s", "MB/s"))
+    for nof_cases in args.cases:
+        for action, cases, elapsed, transferred in run(nof_cases, args):
+            rate = cases / elapsed if elapsed > 0 else float("inf")
+            mb_rate = "-"
+            if transferred:
+                mb_rate = "%.1f" % (transferred / elapsed / 1024 / 1024)
+            print("{:<12} {:>8} {:>10.3f} {:>12.1f} {:>10}".format(action, cases, elapsed, rate, mb_rate))
+
+
+if __name__ == "__main__":
+    main()
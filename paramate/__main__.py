@@ -11,6 +11,9 @@ from common import _printer, ProgressBar
 from study import Study, StudyGenerator
 from postprocessing import create_results_table
 from files import RemotesFile
+from monitor import StatusCache, StatusMonitor, DEFAULT_INTERVAL
+from ingest import ingest_study, DEFAULT_CHUNK_SIZE
+from archive import archive_cases, extract_cases
 from contextlib import contextmanager
 
 import colorama as color
@@ -100,7 +103,6 @@ def get_remote(study_path, remote_name_in):
 
     remotes = RemotesFile(study_path)
     remotes.load()
-    r = remote.Remote()
     # Set to "default" if args.remote is None
     if remote_name_in == None:
         remote_name = remotes.default_remote
@@ -111,6 +113,10 @@ def get_remote(study_path, remote_name_in):
         remote_yaml = remotes[remote_name]
     except KeyError:
         raise Exception("Remote '{}' not found in 'remotes.yaml'.".format(remote_name))
+    if remote_yaml["resource-manager"] == "local":
+        r = remote.LocalRemote()
+    else:
+        r = remote.Remote()
     r.configure(remote_name, remote_yaml)
     return r
 
@@ -149,7 +155,27 @@ def postproc_action(args):
         except Exception as err:
             raise
             raise Exception("File 'postproc.py' not found in study directory.")
-        create_results_table(postproc.POSTPROC_TABLE_FIELDS, study)
+        tables_rows = None
+        if args.remote is not None:
+            # '--remote' without a name uses the default remote
+            r = get_remote(study_path, args.remote if args.remote is not True else None)
+            study.set_selection(study.get_cases([r.name], "remote"))
+            if not study.case_selection:
+                raise Exception("No cases found in remote '{}'.".format(r.name))
+            connect(r, debug=args.debug)
+            sm = remote.StudyManager(study)
+            try:
+                if args.fetch:
+                    tables_rows = sm.fetch_postproc(r)
+                else:
+                    tables_rows = sm.remote_postproc(r, as_job=args.job, jobs=args.jobs, use_cache=not args.no_cache)
+            finally:
+                r.close()
+            if tables_rows is None:
+                _printer.print_msg("Use 'postproc --remote --fetch' to get the tables once the job finishes.")
+                return
+        create_results_table(postproc.POSTPROC_TABLE_FIELDS, study, tables_rows, args.jobs, not args.no_cache,
+                             args.chunk_size, getattr(postproc, "POSTPROC_SETUP", None))
 
     _printer.indent_level = 0
     _printer.print_msg("Done.", "info")
@@ -167,7 +193,11 @@ def generate_action(args):
         r = None
         if args.local_remote is not None:
             r = get_remote(study_path, args.local_remote)
-        sb.generate_cases(r)
+        case_ids = None
+        if args.ids_file is not None:
+            with open(args.ids_file, 'r') as ids_file:
+                case_ids = [int(line) for line in ids_file if line.strip()]
+        sb.generate_cases(r, case_ids)
     _printer.print_msg("Done.", "info")
 
 def delete_action(args):
@@ -189,6 +219,39 @@ def delete_action(args):
             _printer.print_msg("Delete aborted.", "info")
     _printer.print_msg("Done.", "info")
 
+def monitor_action(args):
+    study_path = os.path.abspath('.')
+    study_name = os.path.basename(study_path)
+    with action_error_handler(args.debug):
+        study = Study(study_name, study_path, load_param_file=False)
+        study.load()
+        if args.remote is not None:
+            remote_names = [args.remote]
+        else:
+            remote_names = sorted(set([c.remote for c in study.get_cases(["SUBMITTED"], "status")]))
+        if not remote_names:
+            _printer.print_msg("No submitted jobs to monitor.")
+            return
+        remotes = [get_remote(study_path, name) for name in remote_names]
+        monitor = StatusMonitor(study, remotes, args.interval)
+        if args.detach:
+            for r in remotes:
+                if r.auth_type == "password" or r.passphrase_required():
+                    raise Exception("Remote '{}' requires a password. Run the monitor without '--detach'.".format(r.name))
+            # Connections do not survive the fork
+            if not monitor.detach():
+                _printer.print_msg("Monitor started in background. Log in '{}'.".format(monitor.cache.log_path))
+                return
+        for r in remotes:
+            connect(r, debug=args.debug)
+        _printer.print_msg("Monitoring {} remotes every {} seconds...".format(len(remotes), args.interval))
+        try:
+            monitor.run(once=args.once)
+        finally:
+            for r in remotes:
+                r.close()
+    _printer.print_msg("Done.", "info")
+
 def remote_init_action(args):
     remote_name = args.remote
     study_path = os.path.abspath('.')
@@ -234,7 +297,7 @@ def get_cases_byremote(cases_idx, study, allowed_states, remote=None):
     if no_remote_cases is None:
         no_remote_cases = []
     remote_info = {}
-    state_list = ["CREATED", "UPLOADED", "SUBMITTED", "FINISHED", "DELETED", "DOWNLOADED"]
+    state_list = ["CREATED", "UPLOADED", "SUBMITTED", "FINISHED", "FAILED", "DELETED", "DOWNLOADED"]
     remotes = []
     if remote is None:
         remotes = cases_remote.keys()
@@ -268,9 +331,10 @@ def get_cases_byremote(cases_idx, study, allowed_states, remote=None):
 
 def job_status_action(args):
     action = "job-status"
-    allowed_states = ["SUBMITTED"]
+    allowed_states = ["SUBMITTED", "FINISHED", "FAILED"]
     def action_func_job_status(study_manager, remote):
-        return study_manager.job_status(remote)
+        # Already refreshed before the action
+        return study_manager.job_status(remote, refresh=False)
 
     def output_handler_job_status(output):
         _printer.indent_level = 2
@@ -295,14 +359,15 @@ def job_delete_action(args):
     def action_func_job_delete(study_manager, remote):
         return study_manager.job_delete(remote)
     def output_handler_job_delete(output):
-        _printer.print_msg("Marked for deletion {} cases. Waiting...".format(output))
+        _printer.print_msg("Deleted {} cases.".format(output))
     state_action(args, action, allowed_states, action_func_job_delete, output_handler_job_delete)
 
 def upload_action(args):
     action = "upload"
     allowed_states = ["CREATED"]
     def action_func_upload(study_manager, remote):
-        return study_manager.upload(remote, array_job=args.array_job, force=args.force)
+        return study_manager.upload(remote, array_job=args.array_job, force=args.force, dedup=args.dedup,
+                                    generate=args.generate)
 
     def output_handler_upload(output):
        pass 
@@ -312,20 +377,63 @@ def upload_action(args):
 
 def download_action(args):
     action = "download"
-    allowed_states = ["SUBMITTED", "FINISHED"]
+    allowed_states = ["SUBMITTED", "FINISHED", "FAILED"]
     def action_func_download(study_manager, remote):
-        return study_manager.download(remote, force=args.force, compress_only=args.compress_only)
+        return study_manager.download(remote, force=args.force, compress_only=args.compress_only,
+                                      incremental=args.incremental, checksum=args.checksum, shards=args.shards)
+    if args.shards < 1:
+        raise Exception("Number of shards must be at least 1.")
     def output_handler_download(output):
        pass 
     progress_bar_download = ProgressBar("Downloading: ")
     state_action(args, action, allowed_states, action_func_download,
                 output_handler_download, progress_bar_download)
+    if args.ingest:
+        ingest_action(args)
+
+def archive_action(args):
+    study_path = os.path.abspath('.')
+    study_name = os.path.basename(study_path)
+    with action_error_handler(args.debug):
+        study = Study(study_name, study_path, load_param_file=False)
+        study.load()
+        cases_idx = decode_case_selector(args.selector, study.nof_cases)
+        if cases_idx is not None:
+            study.set_selection(cases_idx)
+        if args.extract:
+            cases = extract_cases(study)
+            _printer.print_msg("Extracted {} cases.".format(len(cases)))
+        else:
+            cases = archive_cases(study, keep=args.keep)
+            _printer.print_msg("Archived {} cases.".format(len(cases)))
+    _printer.indent_level = 0
+    _printer.print_msg("Done.", "info")
+
+def ingest_action(args):
+    study_path = os.path.abspath('.')
+    study_name = os.path.basename(study_path)
+    with action_error_handler(args.debug):
+        study = Study(study_name, study_path)
+        study.load()
+        cases_idx = decode_case_selector(args.selector, study.nof_cases)
+        if cases_idx is not None:
+            study.set_selection(cases_idx)
+        files = getattr(args, "files", None)
+        if files:
+            entries = [{"path": f} for f in files]
+        else:
+            entries = study.param_file.data.get("INGEST", [])
+        ingest_study(study, entries, getattr(args, "store", None),
+                     getattr(args, "chunk_size", None) or DEFAULT_CHUNK_SIZE)
+    _printer.indent_level = 0
+    _printer.print_msg("Done.", "info")
 
 def state_action(args, action, allowed_states, action_func, output_handler, action_progress_bar=None):
     study_path = os.path.abspath('.')
     study_name = os.path.basename(study_path)
     study = Study(study_name, study_path)
     study.load()
+    cache = StatusCache(study_path)
     if args.selector is None:
         case_selector = "*"
     else:
@@ -390,10 +498,16 @@ def state_action(args, action, allowed_states, action_func, output_handler, acti
             continue
         with action_error_handler(args.debug):
             r = get_remote(study_path, remote_name)
-            connect(r, debug=args.debug, progress_bar=action_progress_bar)
             sm = remote.StudyManager(study)
-            # The update affect all cases not only the selection
-            sm.update_status(r)
+            # Job states are kept up to date by the monitor when running
+            if cache.fresh(remote_name):
+                _printer.print_msg("Using job states from the monitor ({:.0f} seconds old).".format(cache.age(remote_name)))
+                if action != "job-status":
+                    connect(r, debug=args.debug, progress_bar=action_progress_bar)
+            else:
+                connect(r, debug=args.debug, progress_bar=action_progress_bar)
+                # The update affect all cases not only the selection
+                sm.update_status(r)
             # Upload is not affected by update_status()
             if action == "upload":
                 valid_cases = remote_cases[remote_name]["valid_cases"]
@@ -445,6 +559,7 @@ def main(args=None):
     parser_generate.add_argument("--build-once", action="store_true", default=False, help="Execute only once the build script.")
     parser_generate.add_argument("--abort-undefined", action="store_false", default=True, help="Abort execution if an undefined parameter is found.")
     parser_generate.add_argument('--local-remote', type=str, help="Local remote name.")
+    parser_generate.add_argument('--ids-file', type=str, help="Create only the cases with the ids listed in this file (one per line).")
 
     # Parser print-tree
     parser_print_tree = subparsers.add_parser('print-tree', help="Print parameter tree.")
@@ -453,7 +568,28 @@ def main(args=None):
     # Parser postproc
     parser_postproc = subparsers.add_parser('postproc', help="Postprocess study. Generates a table.")
     parser_postproc.set_defaults(func=postproc_action)
-
+    parser_postproc.add_argument('-r', '--remote', type=str, nargs='?', const=True, help="Postprocess in the remote (default remote if no name given). Only the tables are downloaded.")
+    parser_postproc.add_argument('--job', action="store_true", help="With '--remote', run as a job after the jobs of the cases.")
+    parser_postproc.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes evaluating the cases.")
+    parser_postproc.add_argument('--chunk-size', type=int, help="Write the tables in chunks of this number of cases. Overridden by 'chunk-size' in the table.")
+    parser_postproc.add_argument('--no-cache', action="store_true", help="Recompute every column group instead of reusing the cached results.")
+    parser_postproc.add_argument('--fetch', action="store_true", help="With '--remote', get the tables of a finished postprocessing job.")
+
+
+    # Parser archive
+    parser_archive = subparsers.add_parser('archive', help="Pack downloaded cases into one zip per case, read in place by postproc.")
+    parser_archive.set_defaults(func=archive_action)
+    parser_archive.add_argument('-s', '--selector', type=str, help="Case selector.")
+    parser_archive.add_argument('--keep', action="store_true", help="Keep the case directories.")
+    parser_archive.add_argument('--extract', action="store_true", help="Extract archived cases back into their directories.")
+
+    # Parser ingest
+    parser_ingest = subparsers.add_parser('ingest', help="Consolidate case output files into one study store.")
+    parser_ingest.set_defaults(func=ingest_action)
+    parser_ingest.add_argument('files', type=str, nargs='*', help="Files relative to the case directory. Default: the 'INGEST' section of 'params.yaml'.")
+    parser_ingest.add_argument('-s', '--selector', type=str, help="Case selector.")
+    parser_ingest.add_argument('-o', '--store', type=str, help="Path of the store. Default: 'results.store' in the study.")
+    parser_ingest.add_argument('--chunk-size', type=int, help="Number of cases per chunk (default {}).".format(DEFAULT_CHUNK_SIZE))
 
     # Parser delete 
     parser_delete = subparsers.add_parser('delete', help="Delete all instances in a study.")
@@ -479,13 +615,19 @@ def main(args=None):
     parser_upload.add_argument('-f', '--force', action="store_true", help="Force upload. Overwrite files.")
     parser_upload.add_argument('-y', '--yes', action="store_true", help="Yes to all.")
     parser_upload.add_argument("--array-job", action="store_true", default=False, help="Upload to run as a array of jobs.")
+    parser_upload.add_argument("--dedup", action="store_true", default=False, help="Upload each distinct file once to the remote store and link it (read-only files) or copy it into the cases.")
+    parser_upload.add_argument("--generate", action="store_true", default=False, help="Upload only the template and study files and generate the cases in the remote.")
 
     # Parser download 
     parser_download = subparsers.add_parser('download', help="download study to remote.")
     parser_download.set_defaults(func=download_action)
     parser_download.add_argument('-f', '--force', action="store_true", help="Force download. Overwrite files.")
     parser_download.add_argument('--compress-only', action="store_true", help="Compress the files in the remote but do not download.")
+    parser_download.add_argument('-i', '--incremental', action="store_true", help="Download only files new or changed since the last download.")
+    parser_download.add_argument('--checksum', action="store_true", help="Compare file checksums when size matches but modification time differs (with --incremental).")
     parser_download.add_argument('-y', '--yes', action="store_true", help="Yes to all.")
+    parser_download.add_argument('--shards', type=int, default=1, help="Split the download in this number of archives, compressed at once in the remote and decompressed while the rest are downloaded.")
+    parser_download.add_argument('--ingest', action="store_true", help="Consolidate the files of the 'INGEST' section into the study store after the download.")
     parser_download_mexgroup = parser_download.add_mutually_exclusive_group()
     parser_download_mexgroup.add_argument('-s', '--selector', type=str, help="Case selector.")
     parser_download_mexgroup.add_argument('-r', '--remote', type=str, help="Remote name.")
@@ -507,6 +649,14 @@ def main(args=None):
     parser_job_status_mexgroup.add_argument('-s', '--selector', type=str, help="Case selector.")
     parser_job_status_mexgroup.add_argument('-r', '--remote', type=str, help="Remote name.")
 
+    # Parser monitor
+    parser_monitor = subparsers.add_parser('monitor', help="Poll the job states periodically and cache them locally.")
+    parser_monitor.set_defaults(func=monitor_action)
+    parser_monitor.add_argument('-r', '--remote', type=str, help="Remote name.")
+    parser_monitor.add_argument('-i', '--interval', type=int, default=DEFAULT_INTERVAL, help="Seconds between polls.")
+    parser_monitor.add_argument('--once', action="store_true", help="Poll once and exit.")
+    parser_monitor.add_argument('-d', '--detach', action="store_true", help="Run in background.")
+
     # Parser job-delete
     parser_job_delete = subparsers.add_parser('job-delete', help="Delete jobs associated with cases.")
     parser_job_delete.set_defaults(func=job_delete_action)
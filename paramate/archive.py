@@ -0,0 +1,57 @@
+import os
+import shutil
+import zipfile
+from common import _printer
+
+# Downloaded cases are packed into one uncompressed zip per case. The central
+# directory of the zip gives random access to every file, and uncompressed
+# members can be memory-mapped in place (see CaseData).
+ARCHIVE_DIRNAME = "archive"
+
+
+def _archive_case(study_path, case):
+    case_path = os.path.join(study_path, case.name)
+    archive = os.path.join(ARCHIVE_DIRNAME, case.name + ".zip")
+    archive_path = os.path.join(study_path, archive)
+    tmp_path = archive_path + ".tmp"
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        for root, dirnames, filenames in os.walk(case_path):
+            dirnames.sort()
+            for f in sorted(filenames):
+                path = os.path.join(root, f)
+                zip_file.write(path, os.path.relpath(path, case_path))
+    os.rename(tmp_path, archive_path)
+    return archive
+
+
+def archive_cases(study, keep=False):
+    cases = [case for case in study.case_selection if case.status == "DOWNLOADED" and
+             os.path.isdir(os.path.join(study.path, case.name))]
+    if not cases:
+        _printer.print_msg("No downloaded cases to archive.")
+        return []
+    archive_dir = os.path.join(study.path, ARCHIVE_DIRNAME)
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+    _printer.print_msg("Archiving {} cases...".format(len(cases)))
+    for case in cases:
+        case.archive = _archive_case(study.path, case)
+    # Directories are only removed once the archives are recorded
+    study.save()
+    if not keep:
+        for case in cases:
+            shutil.rmtree(os.path.join(study.path, case.name))
+    return cases
+
+
+def extract_cases(study):
+    cases = [case for case in study.case_selection if getattr(case, "archive", None) is not None]
+    _printer.print_msg("Extracting {} cases...".format(len(cases)))
+    for case in cases:
+        archive_path = os.path.join(study.path, case.archive)
+        with zipfile.ZipFile(archive_path, 'r') as zip_file:
+            zip_file.extractall(os.path.join(study.path, case.name))
+        case.archive = None
+        study.save()
+        os.remove(archive_path)
+    return cases
@@ -1,6 +1,6 @@
 import time
 
-JOB_STATES = ["CREATED", "UPLOADED", "SUBMITTED", "FINISHED", "DOWNLOADED"]
+JOB_STATES = ["CREATED", "UPLOADED", "SUBMITTED", "FINISHED", "FAILED", "DELETED", "DOWNLOADED"]
 class Case:
     def __init__(self, id=None, params=None, singleval_params=None, name=None, short_name=False,
                  job_id=None, status="CREATED", submission_date=None, remote=None): 
@@ -13,6 +13,12 @@ class Case:
         self.status = status
         self.submission_date = submission_date
         self.remote = remote
+        self.array_job_id = None
+        # State and exit code reported by the scheduler
+        self.job_state = None
+        self.exit_code = None
+        # Zip archive of the case made by 'paramate archive', relative to the study
+        self.archive = None
         self.creation_date = time.strftime("%c")
 
     def init_from_dict(self, attrs):
@@ -21,6 +27,9 @@ class Case:
 
     def reset(self):
         self.job_id = None
+        self.array_job_id = None
+        self.job_state = None
+        self.exit_code = None
         self.status = "CREATED"
         self.sub_date = None
         self.remote = None
@@ -0,0 +1,196 @@
+import os
+import struct
+import fnmatch
+import zipfile
+
+# Read access to the files of a case for the column functions of 'postproc.py'.
+# Functions taking two arguments get a CaseData besides the case. The same
+# CaseData is shared by all the column groups and tables of a case and released
+# afterwards. Cases packed by 'paramate archive' are read from their zip archive
+# without extracting it. Like 'postproc_runner.py' it is shipped to the remote,
+# so numpy is only imported when an array is requested.
+DEFAULT_DOWNLOAD_DIRS = ["output", "postproc"]
+TEXT_TABLE_EXTS = {".txt": None, ".dat": None, ".csv": ","}
+
+
+class CaseData:
+    def __init__(self, case, study_path, download_entries=None, setup=None):
+        self.case = case
+        self.path = os.path.join(study_path, case.name)
+        # The directory of the case takes precedence, e.g. after a new download
+        self.archive_path = None
+        if getattr(case, "archive", None) is not None and not os.path.isdir(self.path):
+            self.archive_path = os.path.join(study_path, case.archive)
+        self._zip = None
+        # Entries of the 'DOWNLOAD' section of 'params.yaml'
+        self.download_entries = download_entries
+        # 'POSTPROC_SETUP' of 'postproc.py'
+        self.setup = setup
+        self._cache = {}
+        self._downloads = None
+        self._context = None
+
+    # Object returned by the setup hook for the case (an empty dict without it),
+    # created on first use. Cached column groups do not trigger it.
+    @property
+    def context(self):
+        if self._context is None:
+            self._context = {}
+            if self.setup is not None:
+                self._context = self.setup(self.case, self)
+        return self._context
+
+    def file_path(self, rel_path):
+        return os.path.join(self.path, rel_path)
+
+    def _archive(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.archive_path, 'r')
+        return self._zip
+
+    # Paths of all the files of the case, relative to the case directory
+    def files(self):
+        if self.archive_path is not None:
+            return [name for name in self._archive().namelist() if not name.endswith("/")]
+        files = []
+        for root, dirnames, filenames in os.walk(self.path):
+            for f in filenames:
+                files.append(os.path.relpath(os.path.join(root, f), self.path))
+        return files
+
+    def exists(self, rel_path):
+        if self.archive_path is not None:
+            try:
+                self._archive().getinfo(rel_path)
+                return True
+            except KeyError:
+                return False
+        return os.path.exists(self.file_path(rel_path))
+
+    # Binary file object
+    def open(self, rel_path):
+        if self.archive_path is not None:
+            return self._archive().open(rel_path)
+        return open(self.file_path(rel_path), 'rb')
+
+    def _cached(self, key, load):
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = load()
+            return value
+
+    # Offset of the data of an uncompressed member in the archive file
+    def _member_offset(self, rel_path):
+        info = self._archive().getinfo(rel_path)
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise Exception("File '{}' is compressed in archive '{}'.".format(rel_path, self.archive_path))
+        with open(self.archive_path, 'rb') as archive_file:
+            archive_file.seek(info.header_offset)
+            # Name and extra field lengths of the local file header
+            name_length, extra_length = struct.unpack("<HH", archive_file.read(30)[26:30])
+        return info.header_offset + 30 + name_length + extra_length
+
+    def _npy_memmap(self, path, offset):
+        import numpy as np
+        with open(path, 'rb') as npy_file:
+            npy_file.seek(offset)
+            version = np.lib.format.read_magic(npy_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npy_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npy_file)
+            data_offset = npy_file.tell()
+        return np.memmap(path, dtype=dtype, mode="r", shape=shape, order="F" if fortran_order else "C",
+                         offset=data_offset)
+
+    # Read-only memory map of a raw binary file or of a '.npy' file, also inside
+    # an archive. Nothing is read until the elements are accessed.
+    def array(self, rel_path, dtype="float64", shape=None, offset=0):
+        import numpy as np
+        path, base_offset = self.file_path(rel_path), 0
+        if self.archive_path is not None:
+            path, base_offset = self.archive_path, self._member_offset(rel_path)
+        if rel_path.endswith(".npy"):
+            return self._cached(("array", rel_path), lambda: self._npy_memmap(path, base_offset))
+        return self._cached(("array", rel_path, str(dtype), shape, offset),
+                            lambda: np.memmap(path, dtype=dtype, mode="r", shape=shape, offset=base_offset + offset))
+
+    # Text table parsed once per case with 'numpy.loadtxt'
+    def table(self, rel_path, **kwargs):
+        import numpy as np
+        def load():
+            with self.open(rel_path) as table_file:
+                return np.loadtxt(table_file, **kwargs)
+        return self._cached(("table", rel_path, tuple(sorted(kwargs.items()))), load)
+
+    def text(self, rel_path):
+        def load():
+            with self.open(rel_path) as text_file:
+                text = text_file.read()
+            return text if isinstance(text, str) else text.decode("utf-8")
+        return self._cached(("text", rel_path), load)
+
+    # Loaded according to the extension: arrays for '.npy', tables for text
+    # tables and the content of the file for the rest
+    def __getitem__(self, rel_path):
+        ext = os.path.splitext(rel_path)[1]
+        if ext == ".npy":
+            return self.array(rel_path)
+        if ext in TEXT_TABLE_EXTS:
+            delimiter = TEXT_TABLE_EXTS[ext]
+            return self.table(rel_path, delimiter=delimiter) if delimiter else self.table(rel_path)
+        return self.text(rel_path)
+
+    # Files of the case selected by the 'DOWNLOAD' section, relative to the case
+    # directory. They are listed on first use and loaded on access.
+    @property
+    def downloads(self):
+        if self._downloads is None:
+            self._downloads = self._download_files()
+        return self._downloads
+
+    def _download_files(self):
+        entries = self.download_entries
+        if entries is None:
+            entries = [{"path": d} for d in DEFAULT_DOWNLOAD_DIRS]
+        return sorted([f for f in self.files() if any([_download_selected(f, entry) for entry in entries])])
+
+    # Size and modification time of the selected files (of the archive for archived
+    # cases), listed again on every call
+    def download_stats(self):
+        if self.archive_path is not None:
+            f_stat = os.stat(self.archive_path)
+            return [(self.case.archive, f_stat.st_size, f_stat.st_mtime)]
+        stats = []
+        for rel_path in self._download_files():
+            try:
+                f_stat = os.stat(self.file_path(rel_path))
+            except OSError:
+                continue
+            stats.append((rel_path, f_stat.st_size, f_stat.st_mtime))
+        return stats
+
+    def release(self):
+        self._cache = {}
+        self._context = None
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+
+# Same selection as the download: files under 'path', restricted to the 'include'
+# patterns or pruning the directories and files matching an 'exclude' pattern
+def _download_selected(rel_path, entry):
+    base_path = os.path.normpath(entry["path"])
+    if base_path == ".":
+        sub_path = rel_path
+    elif rel_path.startswith(base_path + os.sep):
+        sub_path = rel_path[len(base_path) + 1:]
+    else:
+        return False
+    parts = sub_path.split(os.sep)
+    if "include" in entry:
+        prefixes = [os.sep.join(parts[:i]) for i in range(1, len(parts) + 1)]
+        return any([fnmatch.fnmatch(prefix, pattern) for prefix in prefixes for pattern in entry["include"]])
+    return not any([fnmatch.fnmatch(part, pattern) for part in parts for pattern in entry.get("exclude", [])])
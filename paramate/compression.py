@@ -0,0 +1,91 @@
+import os
+import shlex
+import tarfile
+import subprocess
+from contextlib import contextmanager
+from distutils.spawn import find_executable
+
+# Map from codec name to (archive extension, executable, default level)
+CODECS = {"none": (".tar", None, None),
+          "gzip": (".tar.gz", "gzip", None),
+          "pigz": (".tar.gz", "pigz", None),
+          "zstd": (".tar.zst", "zstd", 3),
+          "lz4": (".tar.lz4", "lz4", 1)}
+DEFAULT_CODEC = "gzip"
+
+
+class Codec:
+    def __init__(self, name=DEFAULT_CODEC, threads=1, level=None):
+        if name not in CODECS:
+            raise Exception("Compression codec '{}' not supported. Use one of {}.".format(name, sorted(CODECS.keys())))
+        self.name = name
+        self.threads = threads
+        self.ext, self.executable, default_level = CODECS[name]
+        self.level = level if level is not None else default_level
+
+    @classmethod
+    def from_config(cls, config):
+        if config is None:
+            return cls()
+        if type(config) == str:
+            return cls(config)
+        return cls(config["codec"], config.get("threads", 1), config.get("level", None))
+
+    def program(self):
+        if self.executable is None:
+            return None
+        args = [self.executable]
+        if self.name == "pigz":
+            args.append("-p%d" % self.threads)
+        elif self.name == "zstd":
+            args.extend(["-T%d" % self.threads, "-q"])
+        if self.level is not None:
+            args.append("-%d" % self.level)
+        return " ".join(args)
+
+    # Flags for a GNU tar command. On extraction tar calls the program with '-d'.
+    def tar_flags(self):
+        if self.name == "none":
+            return ""
+        elif self.name == "gzip":
+            return "-z"
+        else:
+            return "--use-compress-program='%s'" % self.program()
+
+    def local_available(self):
+        return self.executable is None or find_executable(self.executable) is not None
+
+    def remote_available(self, remote):
+        return self.executable is None or remote.cmd_avail(self.executable)
+
+    # Tar archives through the codec. Gzip and uncompressed archives are handled
+    # by tarfile, the rest are streamed through the codec program.
+    @contextmanager
+    def open_local(self, path, mode):
+        assert mode in ("r", "w")
+        if self.name in ("none", "gzip"):
+            tar_mode = mode if self.name == "none" else mode + ":gz"
+            with tarfile.open(path, tar_mode) as tar:
+                yield tar
+            return
+        args = shlex.split(self.program())
+        if mode == "w":
+            with open(path, "wb") as archive:
+                proc = subprocess.Popen(args + ["-c"], stdin=subprocess.PIPE, stdout=archive)
+                try:
+                    with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                        yield tar
+                finally:
+                    proc.stdin.close()
+                    status = proc.wait()
+        else:
+            with open(path, "rb") as archive:
+                proc = subprocess.Popen(args + ["-d", "-c"], stdin=archive, stdout=subprocess.PIPE)
+                try:
+                    with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                        yield tar
+                finally:
+                    proc.stdout.close()
+                    status = proc.wait()
+        if status != 0:
+            raise Exception("Command '{}' failed with exit status {} on '{}'.".format(self.executable, status, os.path.basename(path)))
@@ -7,11 +7,14 @@ import shutil
 import re
 import sys
 import json
+import fcntl
+from contextlib import contextmanager
 from anytree import Node, PreOrderIter, RenderTree
 from anytree.importer import DictImporter
 from anytree.render import AsciiStyle 
 from study import Case
 from common import ParamInstance, _printer
+from casedata import CaseData
 import imp
 
 
@@ -20,6 +23,7 @@ class InfoFile:
         self.fname = fname
         self.file_path = os.path.join(os.path.abspath(path), fname)
         self.loaded = False
+        self._lock_file = None
 
     def backup(self, dest):
         shutil.copy(self.file_path, os.path.join(dest, "cases.info.bak"))
@@ -51,9 +55,31 @@ class InfoFile:
     def remove(self):
         os.remove(self.file_path)
 
+    # Exclusive lock between the paramate processes writing the file (the monitor
+    # and the commands). Reentrant for the same InfoFile.
+    @contextmanager
+    def lock(self):
+        if self._lock_file is not None:
+            yield
+            return
+        self._lock_file = open(self.file_path + ".lock", 'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the lock
+            self._lock_file.close()
+            self._lock_file = None
+
+    # Written to a temporary file and renamed, as the monitor may be reading it
     def save(self, cases, params):
+        with self.lock():
+            self._save(cases, params)
+
+    def _save(self, cases, params):
         json_data = {"cases" : [], "params": params}
-        with open(self.file_path, 'w') as wfile:
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, 'w') as wfile:
             for i, case in enumerate(cases):
                 case_dict = case.__dict__.copy()
                 case_dict_singv_params = {}
@@ -66,6 +92,7 @@ class InfoFile:
                 case_dict["singleval_params"] = case_dict_singv_params
                 json_data["cases"].append(case_dict)
             wfile.write(json.dumps(json_data, indent=4, sort_keys=True))
+        os.rename(tmp_path, self.file_path)
 
 class Section(object):
     def __init__(self, sections, data, study_path, example_str, name):
@@ -202,6 +229,24 @@ class DownloadSection(Section):
                 self._check_list("exclude", e1["include"], str)
         self.checked = True
 
+class IngestSection(Section):
+    def __init__(self, sections, data, study_path):
+        example_str = "INGEST:\n" +\
+                      "    - path: output/velocity.npy\n" +\
+                      "      name: velocity\n" +\
+                      "    - path: output/pressure.bin\n" +\
+                      "      dtype: float32"
+        super(IngestSection, self).__init__(sections, data, study_path, example_str, "INGEST")
+
+    def _check(self):
+        self._check_list("INGEST", self.data, dict)
+        allowed_fields = {"path": (str, True, None),
+                          "name": (str, False, None),
+                          "dtype": (str, False, None)}
+        for e1 in self.data:
+            self._check_dict("INGEST", e1, allowed_fields)
+        self.checked = True
+
 class ParamsSection(Section):
     def __init__(self, sections, data, study_path, example_str, name):
         super(ParamsSection, self).__init__(sections, data, study_path, example_str, name) 
@@ -451,9 +496,14 @@ class RemoteSection(Section):
                           "ssh-key": (dict, False, None),
                           "remote-workdir": (str, True, None),
                           "shell": (str, False, ["bash", "csh"]),
-                          "resource-manager": (str, True, ["pbs", "sge", "slurm"]),
+                          "resource-manager": (str, True, ["pbs", "sge", "slurm", "local"]),
                           "jobs-commands": (dict, False, None),
                           "config-host": (str, False, None),
+                          "compression": ((str, dict), False, None),
+                          "transfer": (dict, False, None),
+                          "local-resources": (dict, False, None),
+                          "python": (str, False, None),
+                          "paramate": (str, False, None),
                           }
         mutual_exc = [("user", "config-host"), ("hostname", "config-host"),
                       ("port", "config-host"), ("ssh-key", "config-host")] 
@@ -466,12 +516,41 @@ class RemoteSection(Section):
         allowed_fields_commands = {"submit": (str, False, None),
                                    "status": (str, False, None),
                                    "delete": (str, False, None),
+                                   "accounting": (str, False, None),
                                   }
         if "ssh-key" in self.data:
             self._check_dict("ssh-key", self.data["ssh-key"], allowed_fields_sshkey)
 
+        allowed_codecs = ["none", "gzip", "pigz", "zstd", "lz4"]
+        allowed_fields_compression = {"codec": (str, True, allowed_codecs),
+                                      "threads": (int, False, None),
+                                      "level": (int, False, None),
+                                     }
+        allowed_fields_transfer = {"streams": (int, False, None),
+                                   "connections": (int, False, None),
+                                   "chunk-size": (int, False, None),
+                                   "verify": (bool, False, None),
+                                   "resume": (bool, False, None),
+                                  }
+        allowed_fields_resources = {"cpus": (int, False, None),
+                                    "memory": (int, False, None),
+                                    "max-jobs": (int, False, None),
+                                   }
         if "jobs-commands" in self.data:
             self._check_dict("jobs-commands", self.data["jobs-commands"], allowed_fields_commands)
+
+        if "transfer" in self.data:
+            self._check_dict("transfer", self.data["transfer"], allowed_fields_transfer)
+
+        if "local-resources" in self.data:
+            self._check_dict("local-resources", self.data["local-resources"], allowed_fields_resources)
+
+        if "compression" in self.data:
+            if type(self.data["compression"]) == dict:
+                self._check_dict("compression", self.data["compression"], allowed_fields_compression)
+            elif self.data["compression"] not in allowed_codecs:
+                raise Exception("Invalid field 'compression' with value '{}' in section '{}'. Only '{}' values are allowed."\
+                                .format(self.data["compression"], self.name, allowed_codecs))
         self.checked = True
 
 
@@ -539,6 +618,7 @@ class ParamFile(Section):
                                  "PARAMS-MULTIVAL": (ParamsMultivalSection, 0),
                                  "PARAMS-SINGLEVAL":(ParamsSinglevalSection, 1) ,
                                  "DOWNLOAD": (DownloadSection, 0),
+                                 "INGEST": (IngestSection, 0),
                                  "BUILD": (BuildSection, 0),
                                  "FILES": (FilesSection, 0)}
         study_path = os.path.abspath(path)
@@ -566,6 +646,7 @@ class ParamFile(Section):
                             "PARAMS-MULTIVAL": (dict, True, None),
                             "PARAMS-SINGLEVAL": (dict, False, None),
                             "DOWNLOAD": (list, False, None),
+                            "INGEST": (list, False, None),
                             "FILES": (list, True, None)}
                             # "BUILD": (dict, False, None)}
         self._check_value_dict("Parameter file", self.data, dict)
@@ -584,9 +665,14 @@ class ParamFile(Section):
             if common_params:
                 raise Exception("Parameter(s) '{}'  with same name.".format(tuple(common_params)))
 
+    # Archived cases keep their files in the archive, whose path is returned instead.
+    # The files inside are read through CaseData ('downloads' and 'open').
     def get_download_paths(self, case):
         path_list = []
         case_path = os.path.join(self.study_path, case.name)
+        data = CaseData(case, self.study_path, self.data.get("DOWNLOAD"))
+        if data.archive_path is not None:
+            return [data.archive_path]
         try:
             paths = self["DOWNLOAD"]
             for path in paths:
@@ -0,0 +1,123 @@
+import os
+import json
+import shutil
+import numpy as np
+from common import _printer
+from casedata import CaseData
+
+# Study-level store of case outputs. Each dataset is a directory of '.npy' chunks
+# holding the arrays of 'chunk-size' consecutive cases concatenated along the
+# first axis, with the offsets of every case in the chunk. 'index.json' lists the
+# cases (id, name and params) in store order and the datasets.
+STORE_DIRNAME = "results.store"
+INDEX_NAME = "index.json"
+DEFAULT_CHUNK_SIZE = 256
+
+
+def dataset_name(entry):
+    return entry.get("name", os.path.splitext(os.path.basename(entry["path"]))[0])
+
+
+def ingest_study(study, entries, store_path=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    if store_path is None:
+        store_path = os.path.join(study.path, STORE_DIRNAME)
+    if not entries:
+        raise Exception("No files to ingest. Add them to the 'INGEST' section of 'params.yaml'.")
+    names = [dataset_name(entry) for entry in entries]
+    if len(set(names)) != len(names):
+        raise Exception("Ingest error - Repeated dataset names in {}.".format(names))
+    cases = []
+    for case in study.case_selection:
+        if all([os.path.exists(os.path.join(study.path, case.name, entry["path"])) for entry in entries]):
+            cases.append(case)
+    if len(cases) < len(study.case_selection):
+        _printer.print_msg("Skipping {} cases without all the files to ingest.".format(len(study.case_selection) - len(cases)),
+                           "warning")
+    _printer.print_msg("Ingesting {} files of {} cases...".format(len(entries), len(cases)))
+    # Built aside and swapped, so readers never see a partial store
+    tmp_path = store_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    datasets = {}
+    for name in names:
+        os.makedirs(os.path.join(tmp_path, name))
+        datasets[name] = {"chunks": 0}
+    for chunk_idx, first in enumerate(range(0, len(cases), chunk_size)):
+        chunk_cases = cases[first:first+chunk_size]
+        arrays = dict([(name, []) for name in names])
+        for case in chunk_cases:
+            data = CaseData(case, study.path)
+            for name, entry in zip(names, entries):
+                # Raw binary files need their dtype
+                if "dtype" in entry:
+                    value = data.array(entry["path"], dtype=entry["dtype"])
+                else:
+                    value = data[entry["path"]]
+                arrays[name].append(np.atleast_1d(np.asarray(value)))
+            data.release()
+        for name in names:
+            _write_chunk(os.path.join(tmp_path, name), chunk_idx, name, arrays[name], datasets[name])
+    index = {"params": study.params,
+             "chunk-size": chunk_size,
+             "cases": [{"id": case.id, "name": case.name, "params": case.params} for case in cases],
+             "datasets": datasets}
+    with open(os.path.join(tmp_path, INDEX_NAME), 'w') as index_file:
+        json.dump(index, index_file, indent=4, sort_keys=True)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(tmp_path, store_path)
+    _printer.print_msg("Created store '{}'.".format(os.path.relpath(store_path, study.path)))
+    return store_path
+
+
+def _write_chunk(dataset_path, chunk_idx, name, arrays, dataset):
+    tail_shape = arrays[0].shape[1:]
+    for array in arrays:
+        if array.shape[1:] != tail_shape:
+            raise Exception("Ingest error - Arrays of '{}' differ in shape beyond the first axis: {} and {}."\
+                            .format(name, tail_shape, array.shape[1:]))
+    offsets = np.cumsum([0] + [len(array) for array in arrays])
+    np.save(os.path.join(dataset_path, "data-%05d.npy" % chunk_idx), np.concatenate(arrays))
+    np.save(os.path.join(dataset_path, "offsets-%05d.npy" % chunk_idx), offsets)
+    dataset.update({"dtype": str(arrays[0].dtype), "shape": list(tail_shape), "chunks": chunk_idx + 1})
+
+
+# Read access to a store. Chunks are memory-mapped, so selecting a few cases only
+# reads their part of the chunk.
+class ResultsStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as index_file:
+            self.index = json.load(index_file)
+        self.cases = self.index["cases"]
+        self.datasets = self.index["datasets"]
+        self.chunk_size = self.index["chunk-size"]
+        self._positions = dict([(case["id"], i) for i, case in enumerate(self.cases)])
+        self._chunks = {}
+
+    def _chunk(self, name, chunk_idx):
+        key = (name, chunk_idx)
+        if key not in self._chunks:
+            dataset_path = os.path.join(self.path, name)
+            self._chunks[key] = (np.load(os.path.join(dataset_path, "data-%05d.npy" % chunk_idx), mmap_mode="r"),
+                                 np.load(os.path.join(dataset_path, "offsets-%05d.npy" % chunk_idx)))
+        return self._chunks[key]
+
+    def get(self, name, case_id):
+        if name not in self.datasets:
+            raise Exception("Dataset '{}' not in store. Available: {}.".format(name, sorted(self.datasets.keys())))
+        try:
+            position = self._positions[case_id]
+        except KeyError:
+            raise Exception("Case with id {} not in store.".format(case_id))
+        data, offsets = self._chunk(name, position // self.chunk_size)
+        i = position % self.chunk_size
+        return data[offsets[i]:offsets[i+1]]
+
+    # Cases whose params match all the given values
+    def select(self, **params):
+        return [case for case in self.cases
+                if all([case["params"].get(p) == v for p, v in params.items()])]
+
+    def arrays(self, name, **params):
+        return [self.get(name, case["id"]) for case in self.select(**params)]
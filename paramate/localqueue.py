@@ -0,0 +1,351 @@
+#!/usr/bin/env python2
+import os
+import re
+import sys
+import time
+import json
+import shlex
+import fcntl
+import signal
+import getpass
+import argparse
+import subprocess
+import multiprocessing
+
+# Job queue of the 'local' resource manager. Jobs are kept in a JSON table inside
+# the queue directory and run by a detached daemon, started on demand, which
+# exits when the queue is empty. The module is executed as a script by the
+# scheduler commands, so it can only depend on the standard library.
+QUEUE_DIRNAME = ".paramate-local"
+LOCAL_SCRIPT = os.path.realpath(__file__).replace(".pyc", ".py")
+ARRAY_INDEX_VAR = "PARAMATE_ARRAY_INDEX"
+# Per-job requirements are read from lines like '#LOCAL --cpus 4 --memory 2048'
+DIRECTIVE = "#LOCAL"
+POLL_INTERVAL = 0.2
+
+# Job states in the table: queued, running, completed and failed
+QUEUED, RUNNING, COMPLETED, FAILED = "Q", "R", "C", "F"
+
+
+def total_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024)
+    except (ValueError, OSError):
+        return 0
+
+
+def _job_key(job_id):
+    # "12[3]" -> (12, 3)
+    match = re.match(r"^(\d+)(?:\[(\d+)\])?$", job_id)
+    return (int(match.group(1)), int(match.group(2) or -1))
+
+
+def _exit_code(returncode):
+    # Killed by a signal
+    if returncode < 0:
+        return 128 - returncode
+    return returncode
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def _parse_directives(script):
+    parser = argparse.ArgumentParser(prog=DIRECTIVE, add_help=False)
+    parser.add_argument('--cpus', type=int, default=1)
+    parser.add_argument('--memory', type=int, default=0)
+    args = []
+    with open(script, 'r') as script_file:
+        for line in script_file:
+            if line.startswith(DIRECTIVE):
+                args.extend(shlex.split(line[len(DIRECTIVE):]))
+    return parser.parse_known_args(args)[0]
+
+
+def _script_command(script):
+    with open(script, 'r') as script_file:
+        first_line = script_file.readline()
+    if first_line.startswith("#!"):
+        return shlex.split(first_line[2:]) + [script]
+    return ["bash", script]
+
+
+class LocalQueue:
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.table_path = os.path.join(queue_dir, "jobs.json")
+        self.lock_path = os.path.join(queue_dir, "lock")
+        self._lock_file = None
+
+    def _lock(self):
+        if not os.path.exists(self.queue_dir):
+            os.makedirs(self.queue_dir)
+        self._lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+        self._lock_file = None
+
+    def load(self):
+        try:
+            with open(self.table_path, 'r') as table_file:
+                return json.load(table_file)
+        except IOError:
+            return {"next-id": 0, "daemon": None, "resources": {}, "jobs": {}}
+
+    # Written to a temporary file and renamed so readers never see it half written
+    def _save(self, table):
+        tmp_path = self.table_path + ".tmp"
+        with open(tmp_path, 'w') as table_file:
+            json.dump(table, table_file)
+        os.rename(tmp_path, self.table_path)
+
+    def jobs(self):
+        return self.load()["jobs"]
+
+    def submit(self, script, array_range=None, resources=None, after=()):
+        script = os.path.abspath(script)
+        requirements = _parse_directives(script)
+        job = {"name": os.path.basename(script),
+               "cwd": os.getcwd(),
+               "script": script,
+               "cpus": requirements.cpus,
+               "memory": requirements.memory,
+               "user": getpass.getuser(),
+               "state": QUEUED,
+               "pid": None,
+               "exit-code": None,
+               "submitted": time.time(),
+               "started": None,
+               "finished": None,
+               "index": None,
+               # Waits for these jobs to finish
+               "after": list(after)}
+        self._lock()
+        try:
+            table = self.load()
+            if resources:
+                table["resources"].update(resources)
+            job_id = str(table["next-id"])
+            table["next-id"] += 1
+            if array_range is None:
+                table["jobs"][job_id] = job
+            else:
+                for index in array_range:
+                    element = dict(job, index=index)
+                    table["jobs"]["%s[%d]" % (job_id, index)] = element
+                job_id += "[]"
+            self._start_daemon(table)
+            self._save(table)
+        finally:
+            self._unlock()
+        return job_id
+
+    def _start_daemon(self, table):
+        if table["daemon"] is not None and _alive(table["daemon"]):
+            return
+        with open(os.devnull, 'r+') as devnull:
+            daemon = subprocess.Popen([sys.executable, LOCAL_SCRIPT, "-d", self.queue_dir, "daemon"],
+                                      stdin=devnull, stdout=devnull, stderr=devnull,
+                                      close_fds=True, preexec_fn=os.setsid)
+        table["daemon"] = daemon.pid
+
+    def _select(self, jobs, job_ids):
+        selected = []
+        for job_id in job_ids:
+            # All the elements of an array job as '12[]'
+            if job_id.endswith("[]"):
+                selected.extend([j for j in jobs if j.startswith(job_id[:-1])])
+            elif job_id in jobs:
+                selected.append(job_id)
+        return selected
+
+    def delete(self, job_ids):
+        self._lock()
+        try:
+            table = self.load()
+            selected = self._select(table["jobs"], job_ids)
+            for job_id in selected:
+                job = table["jobs"][job_id]
+                if job["state"] == QUEUED:
+                    job["state"] = FAILED
+                    job["finished"] = time.time()
+                # The daemon records the exit code
+                elif job["state"] == RUNNING:
+                    try:
+                        os.killpg(job["pid"], signal.SIGTERM)
+                    except OSError:
+                        pass
+            self._save(table)
+        finally:
+            self._unlock()
+        return selected
+
+    def status_lines(self, job_ids=None):
+        jobs = self.jobs()
+        if job_ids:
+            selected = self._select(jobs, job_ids)
+        else:
+            selected = [j for j in jobs if jobs[j]["state"] in (QUEUED, RUNNING)]
+        lines = ["{:<16} {:<16} {:<12} {:>8} {:<1} {}".format("Job id", "Name", "User", "Time", "S", "Queue"),
+                 "-" * 64]
+        now = time.time()
+        for job_id in sorted(selected, key=_job_key):
+            job = jobs[job_id]
+            elapsed = 0
+            if job["started"] is not None:
+                elapsed = int((job["finished"] or now) - job["started"])
+            elapsed_str = "%02d:%02d:%02d" % (elapsed / 3600, elapsed % 3600 / 60, elapsed % 60)
+            lines.append("{:<16} {:<16} {:<12} {:>8} {:<1} {}".format(job_id, job["name"][:16], job["user"][:12],
+                                                                      elapsed_str, job["state"], "local"))
+        return lines
+
+    def run_daemon(self):
+        procs = {}
+        while True:
+            self._lock()
+            try:
+                table = self.load()
+                if table["daemon"] != os.getpid() and table["daemon"] is not None and _alive(table["daemon"]):
+                    return
+                table["daemon"] = os.getpid()
+                changed = self._reap(table, procs)
+                changed = self._launch(table, procs) or changed
+                queued = [j for j in table["jobs"].values() if j["state"] == QUEUED]
+                if not queued and not procs:
+                    table["daemon"] = None
+                    self._save(table)
+                    return
+                if changed:
+                    self._save(table)
+            finally:
+                self._unlock()
+            time.sleep(POLL_INTERVAL)
+
+    def _reap(self, table, procs):
+        changed = False
+        for job_id, proc in procs.items():
+            returncode = proc.poll()
+            if returncode is None:
+                continue
+            job = table["jobs"][job_id]
+            job["exit-code"] = _exit_code(returncode)
+            job["state"] = COMPLETED if returncode == 0 else FAILED
+            job["finished"] = time.time()
+            del procs[job_id]
+            changed = True
+        # Jobs left running by a previous daemon that died
+        for job_id, job in table["jobs"].items():
+            if job["state"] == RUNNING and job_id not in procs and not _alive(job["pid"]):
+                job["state"] = FAILED
+                job["finished"] = time.time()
+                changed = True
+        return changed
+
+    def _launch(self, table, procs):
+        resources = table["resources"]
+        cpus = resources.get("cpus") or multiprocessing.cpu_count()
+        memory = resources.get("memory") or total_memory()
+        max_jobs = resources.get("max-jobs") or cpus
+        running = [j for j in table["jobs"].values() if j["state"] == RUNNING]
+        # Jobs bigger than the whole machine run alone
+        used_cpus = sum([min(j["cpus"], cpus) for j in running])
+        used_memory = sum([min(j["memory"], memory) for j in running])
+        changed = False
+        for job_id in sorted([j for j in table["jobs"] if table["jobs"][j]["state"] == QUEUED], key=_job_key):
+            if len(running) >= max_jobs:
+                break
+            job = table["jobs"][job_id]
+            if self._waiting(table["jobs"], job):
+                continue
+            job_cpus = min(job["cpus"], cpus)
+            job_memory = min(job["memory"], memory)
+            if used_cpus + job_cpus > cpus or used_memory + job_memory > memory:
+                continue
+            procs[job_id] = self._run(job_id, job)
+            job["state"] = RUNNING
+            job["pid"] = procs[job_id].pid
+            job["started"] = time.time()
+            running.append(job)
+            used_cpus += job_cpus
+            used_memory += job_memory
+            changed = True
+        return changed
+
+    def _waiting(self, jobs, job):
+        for job_id in self._select(jobs, job.get("after", [])):
+            if jobs[job_id]["state"] in (QUEUED, RUNNING):
+                return True
+        return False
+
+    def _run(self, job_id, job):
+        env = dict(os.environ)
+        env["PARAMATE_JOB_ID"] = job_id
+        if job["index"] is not None:
+            env[ARRAY_INDEX_VAR] = str(job["index"])
+        # Output files named as PBS does: <script name>.o<job id>
+        job_number = job_id.split("[")[0]
+        suffix = job_number if job["index"] is None else "%s.%d" % (job_number, job["index"])
+        stdout = open(os.path.join(job["cwd"], "%s.o%s" % (job["name"], suffix)), 'w')
+        stderr = open(os.path.join(job["cwd"], "%s.e%s" % (job["name"], suffix)), 'w')
+        try:
+            with open(os.devnull, 'r') as devnull:
+                return subprocess.Popen(_script_command(job["script"]), cwd=job["cwd"], env=env,
+                                        stdin=devnull, stdout=stdout, stderr=stderr,
+                                        close_fds=True, preexec_fn=os.setsid)
+        finally:
+            stdout.close()
+            stderr.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Job queue of the 'local' resource manager.")
+    parser.add_argument('-d', '--queue-dir', type=str, required=True, help="Queue directory.")
+    subparsers = parser.add_subparsers()
+    parser_submit = subparsers.add_parser('submit')
+    parser_submit.set_defaults(action="submit")
+    parser_submit.add_argument('-J', '--array', type=str, help="Array indices range 'first-last'.")
+    parser_submit.add_argument('--cpus', type=int, help="CPUs available to the queue.")
+    parser_submit.add_argument('--memory', type=int, help="Memory (MB) available to the queue.")
+    parser_submit.add_argument('--max-jobs', type=int, help="Maximum number of jobs running at once.")
+    parser_submit.add_argument('--after', type=str, help="Comma separated ids of the jobs to wait for.")
+    parser_submit.add_argument('script', type=str)
+    parser_status = subparsers.add_parser('status')
+    parser_status.set_defaults(action="status")
+    parser_status.add_argument('job_ids', type=str, nargs='*')
+    parser_delete = subparsers.add_parser('delete')
+    parser_delete.set_defaults(action="delete")
+    parser_delete.add_argument('job_ids', type=str, nargs='+')
+    parser_daemon = subparsers.add_parser('daemon')
+    parser_daemon.set_defaults(action="daemon")
+    args = parser.parse_args(args)
+
+    queue = LocalQueue(args.queue_dir)
+    if args.action == "submit":
+        array_range = None
+        if args.array is not None:
+            first, last = [int(i) for i in args.array.split("-")]
+            array_range = range(first, last + 1)
+        resources = dict([(k, v) for k, v in (("cpus", args.cpus), ("memory", args.memory),
+                                              ("max-jobs", args.max_jobs)) if v is not None])
+        after = args.after.split(",") if args.after else ()
+        print(queue.submit(args.script, array_range, resources, after))
+    elif args.action == "status":
+        for line in queue.status_lines(args.job_ids):
+            print(line)
+    elif args.action == "delete":
+        if not queue.delete(args.job_ids):
+            sys.exit("No jobs found with ids %s." % " ".join(args.job_ids))
+    elif args.action == "daemon":
+        queue.run_daemon()
+
+
+if __name__ == "__main__":
+    main()
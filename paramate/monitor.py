@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+from common import _printer
+from remote import StudyManager
+
+# Local state of the study kept by paramate
+CACHE_DIRNAME = ".paramate"
+DEFAULT_INTERVAL = 60
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+# Job states of each remote as last seen by the monitor
+class StatusCache:
+    def __init__(self, study_path):
+        self.dir_path = os.path.join(study_path, CACHE_DIRNAME)
+        self.path = os.path.join(self.dir_path, "status.json")
+        self.pid_path = os.path.join(self.dir_path, "monitor.pid")
+        self.log_path = os.path.join(self.dir_path, "monitor.log")
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _write(self, path, text):
+        if not os.path.exists(self.dir_path):
+            os.makedirs(self.dir_path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+
+    def update(self, remote_name, interval, cases):
+        data = self.load()
+        jobs = {}
+        for case in cases:
+            if case.job_id is not None:
+                jobs[case.job_id] = {"case": case.name, "status": case.status,
+                                     "state": case.job_state, "exit-code": case.exit_code}
+        data[remote_name] = {"updated": time.time(), "interval": interval, "jobs": jobs}
+        self._write(self.path, json.dumps(data, indent=4, sort_keys=True))
+
+    def age(self, remote_name):
+        entry = self.load().get(remote_name)
+        if entry is None:
+            return None
+        return time.time() - entry["updated"]
+
+    # Fresh while the monitor is running and has polled the remote within two intervals
+    def fresh(self, remote_name):
+        entry = self.load().get(remote_name)
+        if entry is None or self.monitor_pid() is None:
+            return False
+        return time.time() - entry["updated"] < 2 * entry["interval"]
+
+    def monitor_pid(self):
+        try:
+            with open(self.pid_path, 'r') as pid_file:
+                pid = int(pid_file.read())
+        except (IOError, ValueError):
+            return None
+        if not _alive(pid):
+            return None
+        return pid
+
+    def write_pid(self):
+        self._write(self.pid_path, str(os.getpid()))
+
+    def remove_pid(self):
+        if os.path.exists(self.pid_path):
+            os.remove(self.pid_path)
+
+
+class StatusMonitor:
+    def __init__(self, study, remotes, interval=DEFAULT_INTERVAL):
+        self.study = study
+        self.remotes = remotes
+        self.interval = interval
+        self.cache = StatusCache(study.path)
+
+    # Forks a background process writing to the monitor log. Returns False in
+    # the calling process and True in the monitor.
+    def detach(self):
+        pid = os.fork()
+        if pid > 0:
+            os.waitpid(pid, 0)
+            return False
+        os.setsid()
+        if os.fork() > 0:
+            os._exit(0)
+        if not os.path.exists(self.cache.dir_path):
+            os.makedirs(self.cache.dir_path)
+        log = open(self.cache.log_path, 'a')
+        with open(os.devnull, 'r') as devnull:
+            os.dup2(devnull.fileno(), sys.stdin.fileno())
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        return True
+
+    def run(self, once=False):
+        pid = self.cache.monitor_pid()
+        if pid is not None and pid != os.getpid():
+            raise Exception("Monitor already running with pid {}.".format(pid))
+        self.cache.write_pid()
+        try:
+            while True:
+                nof_active = sum([self.poll(r) for r in self.remotes])
+                if once or nof_active == 0:
+                    break
+                time.sleep(self.interval)
+        finally:
+            self.cache.remove_pid()
+
+    # Returns the number of jobs still active in the remote
+    def poll(self, remote):
+        try:
+            # Pick up the changes made by other commands meanwhile
+            self.study.load()
+            active_job_ids = StudyManager(self.study).update_status(remote)
+        except Exception as error:
+            _printer.print_msg("Remote '{}' not polled: {}".format(remote.name, error), "warning")
+            self._reconnect(remote)
+            # Keep polling after a failure
+            return 1
+        self.cache.update(remote.name, self.interval, self.study.get_cases([remote.name], "remote"))
+        _printer.print_msg("{} - '{}': {} jobs active.".format(time.strftime("%c"), remote.name, len(active_job_ids)))
+        return len(active_job_ids)
+
+    def _reconnect(self, remote):
+        try:
+            remote.close()
+            remote.connect(remote._passwd, remote._timeout)
+        except Exception as error:
+            _printer.print_msg("Reconnection to '{}' failed: {}".format(remote.name, error), "warning")
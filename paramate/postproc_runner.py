@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import pickle
+import marshal
+import hashlib
+import argparse
+import collections
+import multiprocessing
+
+# Evaluates the column functions of 'postproc.py' over the cases of a study and
+# writes the rows of every table as JSON. It is shipped to the remote together
+# with 'case.py' for 'postproc --remote', so it only depends on the standard
+# library and runs with both Python 2 and 3.
+from case import Case
+from casedata import CaseData
+
+# Results of the column groups of every case, relative to the study directory
+CACHE_DIR = os.path.join(".paramate", "postproc-cache")
+
+
+def table_columns(table_data, study_params):
+    cols = []
+    if table_data["param-cols"]:
+        cols.extend(study_params)
+    for cols_group in table_data["cols"]:
+        cols.extend(cols_group)
+    group_sets = [set(g) for g in table_data["cols"]]
+    if len(group_sets) > 1:
+        common_cols = set.intersection(*group_sets)
+        if common_cols:
+            raise Exception("Common columns found between the groups specified -> {}.".format(tuple(common_cols)))
+    return cols
+
+
+# The result of a column group is reused while neither the module of its function
+# ('postproc.py', with its helpers and constants) nor the downloaded files of the
+# case change. Each table keeps one file per case.
+class RowCache:
+    def __init__(self, study_path, table_name):
+        self.study_path = study_path
+        self.path = os.path.join(study_path, CACHE_DIR, table_name)
+
+    def _case_path(self, case):
+        return os.path.join(self.path, case.name + ".pkl")
+
+    def load(self, case):
+        try:
+            with open(self._case_path(case), 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except Exception:
+            return {}
+
+    def save(self, case, entries):
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Created meanwhile by another worker
+                pass
+        tmp_path = "%s.%d.tmp" % (self._case_path(case), os.getpid())
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(entries, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self._case_path(case))
+
+    @staticmethod
+    def input_key(data):
+        digest = hashlib.sha1()
+        for rel_path, size, mtime in data.download_stats():
+            digest.update(("%s %d %r\n" % (rel_path, size, mtime)).encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def function_key(func):
+        code = getattr(func, "__code__", None)
+        if code is None:
+            return None
+        digest = hashlib.sha1(marshal.dumps(code))
+        digest.update(_module_digest(func).encode("utf-8"))
+        return digest.hexdigest()
+
+
+# Digests of the source of the modules of the column functions, by path and stat
+_module_digests = {}
+
+
+def _module_digest(func):
+    module = sys.modules.get(getattr(func, "__module__", None))
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return ""
+    if path.endswith((".pyc", ".pyo")):
+        path = path[:-1]
+    try:
+        f_stat = os.stat(path)
+    except OSError:
+        return ""
+    key = (path, f_stat.st_size, f_stat.st_mtime)
+    if key not in _module_digests:
+        with open(path, 'rb') as module_file:
+            _module_digests[key] = hashlib.sha1(module_file.read()).hexdigest()
+    return _module_digests[key]
+
+
+# Functions with a second argument get the CaseData of the case
+def _takes_data(func):
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return False
+    # Variable positional arguments
+    if code.co_flags & 0x04:
+        return True
+    return code.co_argcount - (1 if getattr(func, "__self__", None) is not None else 0) > 1
+
+
+def case_row(table_data, cols, study_params, case, cache=None, data=None):
+    row = None
+    cached, entries, input_key = {}, {}, None
+    computed = False
+    if cache is not None:
+        cached = cache.load(case)
+        input_key = cache.input_key(data)
+    for cols_group, group_func in table_data["cols"].items():
+        func_key = cache.function_key(group_func) if cache is not None else None
+        entry = cached.get(cols_group)
+        if func_key is not None and entry is not None and entry[:2] == (func_key, input_key):
+            group_row = entry[2]
+        else:
+            group_row = group_func(case, data) if _takes_data(group_func) else group_func(case)
+            computed = True
+        if func_key is not None:
+            entries[cols_group] = (func_key, input_key, group_row)
+        if group_row is None:
+            if table_data["keep-empty-values"]:
+                group_row = dict([(key, None) for key in cols])
+            else:
+                continue
+        group_diff = set(cols_group).difference(set(group_row.keys()))
+        if group_diff:
+            raise Exception("Error in keys differ in {}.".format(group_diff))
+        if row is None:
+            row = dict(group_row)
+        else:
+            row.update(group_row)
+        if table_data["param-cols"]:
+            row.update(dict([(pname, case.params[pname]) for pname in study_params]))
+    # Files written by the functions into the downloaded directories are part of
+    # the key, so they do not invalidate the entries on the next run
+    if computed and entries:
+        input_key = cache.input_key(data)
+        entries = dict([(cols_group, (func_key, input_key, group_row))
+                        for cols_group, (func_key, old_key, group_row) in entries.items()])
+    if cache is not None and (set(entries.keys()) != set(cached.keys()) or
+                              any([entries[k][:2] != cached[k][:2] for k in entries])):
+        cache.save(case, entries)
+    return row
+
+
+# Set before the pool is created, so the workers inherit the column functions
+_pool_tables = None
+
+
+# All the tables are evaluated for a case at once, so the CaseData (and the
+# context of the setup hook) is shared by every column group of every table.
+def _case_rows(tables, study_params, case, caches, data_factory):
+    data = data_factory(case)
+    try:
+        rows = {}
+        for table_name, table_data, cols in tables:
+            rows[table_name] = case_row(table_data, cols, study_params, case, caches.get(table_name), data)
+        return rows, None
+    except Exception as error:
+        return None, "{}: {}".format(type(error).__name__, error)
+    finally:
+        data.release()
+
+
+def _pool_case_rows(case):
+    tables, study_params, caches, data_factory = _pool_tables
+    return _case_rows(tables, study_params, case, caches, data_factory)
+
+
+def _pool_rows(tables, study_params, cases, jobs, caches, data_factory):
+    global _pool_tables
+    _pool_tables = (tables, study_params, caches, data_factory)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # Chunks small enough to keep every worker busy until the end
+        chunk_size = max(1, len(cases) // (jobs * 4))
+        results = list(pool.imap(_pool_case_rows, cases, chunk_size))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _pool_tables = None
+    return results
+
+
+# Returns the rows of every table of 'postproc_struct' in case order. With 'jobs' > 1
+# the cases are evaluated in a pool of processes. Every failing case is reported in
+# the exception raised. 'caches' maps table names to their RowCache and
+# 'data_factory' builds the CaseData of a case, by default from the current directory.
+def study_rows(postproc_struct, study_params, cases, jobs=1, caches=None, data_factory=None):
+    tables = [(table_name, table_data, table_columns(table_data, study_params))
+              for table_name, table_data in postproc_struct.items()]
+    if caches is None:
+        caches = {}
+    if data_factory is None:
+        study_path = os.getcwd()
+        data_factory = lambda case: CaseData(case, study_path)
+    if jobs > 1 and len(cases) > 1:
+        results = _pool_rows(tables, study_params, cases, jobs, caches, data_factory)
+    else:
+        results = [_case_rows(tables, study_params, case, caches, data_factory) for case in cases]
+    tables_rows = dict([(table_name, collections.OrderedDict()) for table_name, table_data, cols in tables])
+    errors = []
+    for case, (rows, error) in zip(cases, results):
+        if error is not None:
+            errors.append("  {}: {}".format(case.name, error))
+            continue
+        for table_name, row in rows.items():
+            if row is not None:
+                tables_rows[table_name][case.name] = row
+    if errors:
+        raise Exception("Postprocessing failed in {} cases:\n{}".format(len(errors), "\n".join(errors)))
+    return tables_rows
+
+
+# Numpy values are converted without importing numpy. Other types would not come
+# back as they were, so they are rejected.
+def _json_value(value):
+    if type(value).__module__ == "numpy":
+        if getattr(value, "ndim", 0) > 0:
+            return value.tolist()
+        return value.item()
+    raise TypeError("Value {!r} of type '{}' in the tables cannot be stored as JSON. "
+                    "Return numbers, strings, booleans, None or lists of them.".format(value, type(value).__name__))
+
+
+# The 'DOWNLOAD' section of 'params.yaml', if yaml is available in the remote
+def _download_entries(study_path):
+    try:
+        import yaml
+        with open(os.path.join(study_path, "params.yaml"), 'r') as param_file:
+            return yaml.safe_load(param_file).get("DOWNLOAD")
+    except Exception:
+        return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Evaluate the tables of 'postproc.py' into a JSON file.")
+    parser.add_argument('study_dir', type=str)
+    parser.add_argument('output', type=str)
+    parser.add_argument('cases_file', type=str, nargs='?', help="File with the names of the cases (one per line).")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of processes.")
+    parser.add_argument('--no-cache', action="store_true", help="Recompute every column group.")
+    args = parser.parse_args(args)
+    study_path, output_path = os.path.abspath(args.study_dir), os.path.abspath(args.output)
+    os.chdir(study_path)
+    # Appended, so a 'postproc.py' shipped next to this script takes precedence
+    sys.path.append(study_path)
+    with open("cases.info", 'r') as info_file:
+        info = json.load(info_file)
+    cases = []
+    for case_dict in info["cases"]:
+        case = Case()
+        case.init_from_dict(case_dict)
+        cases.append(case)
+    if args.cases_file is not None:
+        with open(args.cases_file, 'r') as names_file:
+            names = set([line.strip() for line in names_file if line.strip()])
+        cases = [case for case in cases if case.name in names]
+    import postproc
+    download_entries = _download_entries(study_path)
+    setup = getattr(postproc, "POSTPROC_SETUP", None)
+    data_factory = lambda case: CaseData(case, study_path, download_entries, setup)
+    caches = {}
+    if not args.no_cache:
+        caches = dict([(table_name, RowCache(study_path, table_name)) for table_name in postproc.POSTPROC_TABLE_FIELDS])
+    tables_rows = study_rows(postproc.POSTPROC_TABLE_FIELDS, info.get("params", []), cases, args.jobs, caches, data_factory)
+    # Pairs, as JSON objects do not keep the order of the cases
+    tables = dict([(table_name, list(rows.items())) for table_name, rows in tables_rows.items()])
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'w') as output_file:
+        json.dump(tables, output_file, default=_json_value)
+    os.rename(tmp_path, output_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,236 @@
+import numpy as np
 import pandas as pd
-from paramate.study import Study
+from postproc_runner import table_columns, study_rows, RowCache
+from casedata import CaseData
 import os
+import shutil
+from collections import OrderedDict
 
 # POSTPROC_TABLE_FIELDS = {"results": 
 #                         {"cols": {
 #                             ("Cv", "P", "D", "Visc", "U"): f1,
 #                             ("tauV", "tauS", "Psi"): f2,},
 #                         "post-func": f_post,
-#                         "output-type": "csv",
+#                         "output-type": "csv", # Or "parquet", "feather", "hdf5"
 #                         "output-directory": results,
+#                         "chunk-size": 1000, # Optional. Stream the table in chunks of cases.
+#                         "dtypes": {"U": "float64"}, # Optional. Otherwise taken from the first chunk.
+#                         "aggregate": {"seeds": {"group-by": ["Cv", "P"], # Written as 'results-seeds'
+#                                                 "reductions": ["mean", "std"]}}, # Or {"U": ["max"]}
 #                         "param-cols": True,
 #                         "keep-empty-values": True,}
 #                    }
 
-def create_results_table(postproc_struct, study):
+
+def _write_csv(data_frame, path, table_name):
+    data_frame.to_csv(path)
+
+def _write_parquet(data_frame, path, table_name):
+    data_frame.to_parquet(path)
+
+# Feather does not store the index, so case names go in the 'case' column
+def _write_feather(data_frame, path, table_name):
+    if data_frame.index.names == [None]:
+        data_frame = data_frame.rename_axis("case")
+    data_frame.reset_index().to_feather(path)
+
+def _write_hdf5(data_frame, path, table_name):
+    data_frame.to_hdf(path, table_name, mode="w")
+
+def _append_csv(data_frame, path, table_name, chunk_idx):
+    data_frame.to_csv(path, mode="w" if chunk_idx == 0 else "a", header=chunk_idx == 0)
+
+# Types are given, as they would be inferred again for every chunk
+def _read_csv(path, table_name, chunk_size, dtypes):
+    return pd.read_csv(path, index_col=0, chunksize=chunk_size, dtype=dtypes)
+
+# Appendable HDF5 tables. Room is left for longer case names in later chunks.
+def _append_hdf5(data_frame, path, table_name, chunk_idx):
+    data_frame.to_hdf(path, table_name, mode="w" if chunk_idx == 0 else "a", format="table",
+                      append=chunk_idx > 0, min_itemsize={"index": 255})
+
+def _read_hdf5(path, table_name, chunk_size, dtypes):
+    return pd.read_hdf(path, table_name, chunksize=chunk_size)
+
+# Parquet and feather tables are streamed as a directory with one file per chunk
+def _parts_appender(writer):
+    def append(data_frame, path, table_name, chunk_idx):
+        if chunk_idx == 0:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            os.makedirs(path)
+        writer(data_frame, os.path.join(path, "part-%05d%s" % (chunk_idx, os.path.splitext(path)[1])), table_name)
+    return append
+
+def _parts_reader(reader):
+    def read(path, table_name, chunk_size, dtypes):
+        for part in sorted(os.listdir(path)):
+            yield reader(os.path.join(path, part))
+    return read
+
+# Map from output type to (file extension, writer, chunk appender, chunk reader).
+# Parquet and feather need 'pyarrow' (or 'fastparquet'), hdf5 needs 'tables'.
+OUTPUT_TYPES = {"csv": (".csv", _write_csv, _append_csv, _read_csv),
+                "parquet": (".parquet", _write_parquet, _parts_appender(_write_parquet),
+                            _parts_reader(pd.read_parquet)),
+                "feather": (".feather", _write_feather, _parts_appender(_write_feather),
+                            _parts_reader(lambda path: pd.read_feather(path).set_index("case"))),
+                "hdf5": (".h5", _write_hdf5, _append_hdf5, _read_hdf5)}
+DEFAULT_OUTPUT_TYPE = "csv"
+
+
+# Built column by column, so pandas infers the dtype of each column once
+def _table_frame(rows, cols):
+    columns = dict([(col, []) for col in cols])
+    for row in rows.values():
+        for col in cols:
+            columns[col].append(row.get(col))
+    return pd.DataFrame(columns, index=list(rows.keys()), columns=cols)
+
+# Pandas infers the types of each chunk on its own, so every chunk is cast to the
+# types of the first one (or the declared ones) and all of them share a schema.
+# Columns with no values in the first chunk are taken as floats (NaN).
+def _chunk_frame(table_name, rows, cols, dtypes):
+    data_frame = _table_frame(rows, cols)
+    for col in cols:
+        if col not in dtypes:
+            dtypes[col] = data_frame[col].dtype
+            if dtypes[col] == object and data_frame[col].isnull().all():
+                dtypes[col] = np.dtype("float64")
+    try:
+        return data_frame.astype(dtypes)
+    except (ValueError, TypeError) as error:
+        raise Exception("Postprocessing error - Chunk of table '{}' does not match the column types {}: {}. "
+                        "Declare them with 'dtypes'.".format(table_name, dict([(c, str(t)) for c, t in dtypes.items()]), error))
+
+# Yields the rows of every table for each chunk of cases
+def _rows_chunks(postproc_struct, study, tables_rows, jobs, use_cache, setup, chunk_size):
+    if tables_rows is not None:
+        nof_rows = max([len(rows) for rows in tables_rows.values()] + [1])
+        for i in range(0, nof_rows, chunk_size):
+            yield dict([(table_name, OrderedDict(tables_rows[table_name][i:i+chunk_size]))
+                        for table_name in postproc_struct])
+        return
+    caches = {}
+    if use_cache:
+        caches = dict([(table_name, RowCache(study.path, table_name)) for table_name in postproc_struct])
+    download_entries = None
+    if study.param_file.loaded:
+        download_entries = study.param_file.data.get("DOWNLOAD")
+    data_factory = lambda case: CaseData(case, study.path, download_entries, setup)
+    cases = study.case_selection
+    for i in range(0, max(len(cases), 1), chunk_size):
+        yield study_rows(postproc_struct, study.params, cases[i:i+chunk_size], jobs, caches, data_factory)
+
+# Reductions are names of pandas reductions ("mean", "std", "min", "max", ...) or
+# functions, for all the columns (or 'columns') or as a dict per column. The result
+# is indexed by the 'group_by' values with columns named '<column>_<reduction>'.
+def aggregate_table(data_frame, group_by, reductions, columns=None):
+    columns = _aggregate_columns(group_by, reductions, columns, data_frame.columns)
+    missing = set(group_by).union(columns).difference(data_frame.columns)
+    if missing:
+        raise Exception("Aggregation error - Columns {} not found in the table.".format(tuple(missing)))
+    grouped = data_frame.groupby(group_by)
+    if isinstance(reductions, dict):
+        aggregated = grouped.agg(dict([(col, red if isinstance(red, list) else [red]) for col, red in reductions.items()]))
+    else:
+        aggregated = grouped[columns].agg(list(reductions))
+    aggregated.columns = ["{}_{}".format(col, getattr(red, "__name__", red)) for col, red in aggregated.columns]
+    return aggregated
+
+def _aggregate_columns(group_by, reductions, columns, table_cols):
+    if isinstance(reductions, dict):
+        return list(reductions.keys())
+    if columns is not None:
+        return list(columns)
+    return [c for c in table_cols if c not in group_by]
+
+def _check_aggregate(table_name, aggregate):
+    if not isinstance(aggregate, dict):
+        raise Exception("Postprocessing error - 'aggregate' of table '{}' has to be a dict.".format(table_name))
+    for agg_name, agg in aggregate.items():
+        if not isinstance(agg, dict) or "group-by" not in agg or "reductions" not in agg:
+            raise Exception("Postprocessing error - Aggregation '{}' of table '{}' needs 'group-by' and 'reductions'."\
+                            .format(agg_name, table_name))
+
+def _write_output(output_type, table_name, write, *args):
+    try:
+        return write(*args)
+    except ImportError as error:
+        raise Exception("Postprocessing error - Output type '{}' of table '{}' not available: {}."\
+                        .format(output_type, table_name, error))
+
+# Rows computed in a remote can be given per table in 'tables_rows'. All the tables
+# are evaluated in one pass over the cases, with 'setup' called once per case (see
+# CaseData.context). Tables with a 'chunk-size' (or all of them if 'chunk_size' is
+# given) are written chunk by chunk and their 'post-func' gets an iterator over the
+# chunks read back from the output, so memory is bounded by the chunk size.
+def create_results_table(postproc_struct, study, tables_rows=None, jobs=1, use_cache=True, chunk_size=None,
+                         setup=None):
+    outputs = {}
+    # Column types of every table, completed with those of the first chunk
+    dtypes = {}
     for table_name, table_data in postproc_struct.items():
-        cols = []
-        if table_data["param-cols"]:
-            cols.extend(study.params)
-        for cols_group in table_data["cols"]:
-            cols.extend(cols_group)
-        group_sets = [set(g) for g in table_data["cols"]]
-        if len(group_sets) > 1:
-            common_cols = set.intersection(*group_sets)
-            if common_cols:
-                raise Exception("Common columns found between the groups specified -> {}.".format(tuple(common_cols)))
-        table_rows = {}
-        for cols_group, group_func in table_data["cols"].items():
-            for case in study.case_selection:
-                row = group_func(case)
-                if row is None:
-                    if table_data["keep-empty-values"]:
-                        row = {key: None for key in cols}
-                    else:
-                        continue
-                group_diff = set(cols_group).difference(set(row.keys()))
-                if group_diff:
-                    raise Exception("Error in keys differ in {}.".format(group_diff))
-                else:
-                    try:
-                        table_rows[case.name].update(row)
-                    except KeyError:
-                        table_rows[case.name] = row
-                    if table_data["param-cols"]:
-                        table_rows[case.name].update({pname: case.params[pname] for pname in study.params})
-        data_frame = pd.DataFrame.from_dict(table_rows, columns=cols, orient="index")
+        output_type = table_data.get("output-type", DEFAULT_OUTPUT_TYPE)
+        if output_type not in OUTPUT_TYPES:
+            raise Exception("Postprocessing error - 'output-type' of table '{}' not supported. Use one of {}."\
+                            .format(table_name, sorted(OUTPUT_TYPES.keys())))
+        table_chunk_size = table_data.get("chunk-size", chunk_size)
+        if table_chunk_size is not None and table_chunk_size < 1:
+            raise Exception("Postprocessing error - 'chunk-size' of table '{}' has to be positive.".format(table_name))
+        _check_aggregate(table_name, table_data.get("aggregate", {}))
+        if "post-func" in table_data.keys() and not callable(table_data["post-func"]):
+            raise Exception("Postprocessing error - 'post-func' for table '{}' is not callable.".format(table_name))
         output_path = study.path
         if "output-directory" in table_data.keys():
             output_path = os.path.join(output_path, table_data["output-directory"])
-        output_path = os.path.join(output_path, "{}.csv".format(table_name))
-        data_frame.to_csv(output_path)
+        output_path = os.path.join(output_path, table_name + OUTPUT_TYPES[output_type][0])
+        outputs[table_name] = (output_type, table_chunk_size, output_path, table_columns(table_data, study.params))
+        dtypes[table_name] = dict(table_data.get("dtypes", {}))
+
+    # The pass goes in chunks of the smallest chunk size. The rows of the tables
+    # without chunk size are kept until the end.
+    chunk_sizes = [table_chunk_size for output_type, table_chunk_size, output_path, cols in outputs.values()
+                   if table_chunk_size is not None]
+    nof_rows = len(study.case_selection) if tables_rows is None else max([len(r) for r in tables_rows.values()] + [0])
+    pass_chunk_size = min(chunk_sizes) if chunk_sizes else max(nof_rows, 1)
+    full_rows = dict([(table_name, OrderedDict()) for table_name in postproc_struct])
+    for chunk_idx, chunk_rows in enumerate(_rows_chunks(postproc_struct, study, tables_rows, jobs, use_cache,
+                                                        setup, pass_chunk_size)):
+        for table_name, rows in chunk_rows.items():
+            output_type, table_chunk_size, output_path, cols = outputs[table_name]
+            if table_chunk_size is None:
+                full_rows[table_name].update(rows)
+            else:
+                _write_output(output_type, table_name, OUTPUT_TYPES[output_type][2],
+                              _chunk_frame(table_name, rows, cols, dtypes[table_name]), output_path, table_name,
+                              chunk_idx)
+
+    for table_name, table_data in postproc_struct.items():
+        output_type, table_chunk_size, output_path, cols = outputs[table_name]
+        ext, writer, appender, reader = OUTPUT_TYPES[output_type]
+        if table_chunk_size is None:
+            data_frame = _table_frame(full_rows[table_name], cols)
+            if dtypes[table_name]:
+                data_frame = data_frame.astype(dtypes[table_name])
+            _write_output(output_type, table_name, writer, data_frame, output_path, table_name)
+        else:
+            data_frame = _write_output(output_type, table_name, reader, output_path, table_name, table_chunk_size,
+                                       dtypes[table_name])
+        for agg_name, agg in sorted(table_data.get("aggregate", {}).items()):
+            agg_frame = data_frame
+            if table_chunk_size is not None:
+                # Only the columns involved are kept from each chunk
+                agg_cols = list(agg["group-by"]) + _aggregate_columns(agg["group-by"], agg["reductions"],
+                                                                      agg.get("columns"), cols)
+                agg_frame = pd.concat([chunk[agg_cols] for chunk in
+                                       _write_output(output_type, table_name, reader, output_path, table_name,
+                                                     table_chunk_size, dtypes[table_name])])
+            agg_frame = aggregate_table(agg_frame, agg["group-by"], agg["reductions"], agg.get("columns"))
+            agg_table_name = "{}-{}".format(table_name, agg_name)
+            _write_output(output_type, agg_table_name, writer, agg_frame,
+                          os.path.join(os.path.dirname(output_path), agg_table_name + ext), agg_table_name)
         if "post-func" in table_data.keys():
-            if not callable(table_data["post-func"]):
-                raise Exception("Postprocessing error - 'post-func' for table '{}' is not callable.".format(table_name))
             table_data["post-func"](data_frame)
-
@@ -14,54 +14,148 @@ import getpass
 import tarfile
 from scp import SCPClient
 import socket
+import io
+import tempfile
+import json
+import pipes
+import hashlib
+import select
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from common import replace_placeholders, _printer
+from case import Case
+from casedata import DEFAULT_DOWNLOAD_DIRS
+from transfer import ContentIndex, STORE_DIRNAME, LINKS_SCRIPT_NAME, file_digest, TransferEngine
+from compression import Codec, DEFAULT_CODEC
+from scheduler import get_scheduler, ACTIVE_STATES, FAILED
 import re
 
 
 #TODO: Refactor Remote to separate configuration-related stuff
 SRC_DIR = os.path.dirname(os.path.realpath(__file__))
 DEFAULTS_DIR = os.path.join(SRC_DIR, "defaults")
-DEFAULT_DOWNLOAD_DIRS = ["output", "postproc"]
+# Identifies the content of an archive kept to resume a transfer
+ARCHIVE_KEY_SUFFIX = ".key"
+# Remote directory (inside the study) of 'postproc --remote'
+POSTPROC_DIRNAME = ".paramate-postproc"
+POSTPROC_RESULTS = "results.json"
+# Ids of the cases to generate with 'upload --generate'
+GENERATE_IDS_NAME = ".paramate-generate.ids"
+# Conservative limit for the length of a remote command line
+MAX_CMD_LENGTH = 32768
+
+# Submits every case listed in the here-document and prints one line per case:
+# <case name> TAB <exit status> TAB <submission command output>
+BULK_SUBMIT_SCRIPT = """#!/bin/sh
+while read -r case; do
+    out=$( (cd "$case" && {submit} submit.sh) 2>&1 )
+    status=$?
+    printf '%s\\t%s\\t%s\\n' "$case" "$status" "$(printf '%s' "$out" | tr '\\t\\n' '  ')"
+done <<'PARAMATE_CASES'
+{cases}
+PARAMATE_CASES
+"""
 
 class CommandExecuter:
+    # Maximum number of channels open at once (OpenSSH 'MaxSessions' defaults to 10)
+    MAX_CHANNELS = 8
+    RECV_SIZE = 32768
 
-    def __init__(self, ssh):
+    def __init__(self, ssh, shell="bash", unalias=()):
         self.ssh = ssh
-        channel = self.ssh.invoke_shell(width=2000)
-        self.stdin = channel.makefile('wb')
-        self.stdout = channel.makefile('r')
-        # This is to avoid welcome messages of SSH servers to interfere in output
-        self.exec_command("echo Paramate SSH session started.")
-
-    def exec_command(self, cmd):
-        """
-
-        :param cmd: the command to be executed on the remote computer
-        :examples:  execute('ls')
-                    execute('finger')
-                    execute('cd folder_name')
-        """
+        self.shell = shell
+        self.unalias = unalias
+
+    # Run through a login shell so the environment (PATH to the scheduler binaries, modules...)
+    # is the same as in an interactive session.
+    def _wrap(self, cmd):
         cmd = cmd.strip('\n')
-        cmd_end  = "\\x4"
-        echo_cmd = "{} ; echo $? ; printf '{}\\n'".format(cmd, cmd_end)
-        self.stdin.write(echo_cmd + '\n')
-        shin = self.stdin
-        self.stdin.flush()
-        shout = []
-        sherr = []
-        exit_status = 0
-        for line in self.stdout:
-            rep_line = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -/]*[@-~]').sub('', line).replace('\b', '').replace('\r', '')
-            # print rep_line
-            if u"\u0004" in rep_line:  
-                exit_status = int(str(shout.pop()).rsplit(None, 1)[0])
-                if exit_status:
-                    sherr = shout
-                    shout = []
+        if self.shell == "csh":
+            # csh reads aliases from ~/.cshrc also when non-interactive
+            if self.unalias:
+                cmd = "unalias %s ; %s" % (" ".join(self.unalias), cmd)
+            return "csh -c %s" % pipes.quote(cmd)
+        return "bash -l -c %s" % pipes.quote(cmd)
+
+    def _open(self, cmd):
+        channel = self.ssh.get_transport().open_session()
+        channel.exec_command(self._wrap(cmd))
+        return channel
+
+    def _collect(self, channel, cmd, deadline=None):
+        stdout = []
+        stderr = []
+        while True:
+            while channel.recv_ready():
+                stdout.append(channel.recv(self.RECV_SIZE))
+            while channel.recv_stderr_ready():
+                stderr.append(channel.recv_stderr(self.RECV_SIZE))
+            # The exit status is sent after all the output
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
                 break
-            elif cmd not in rep_line:
-                shout.append(rep_line)
-        return shin, shout, sherr, exit_status
+            wait = 1.0
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    channel.close()
+                    raise CmdTimeout("Command '%s' timed out." % cmd)
+                wait = min(wait, 1.0)
+            select.select([channel], [], [], wait)
+        exit_status = channel.recv_exit_status()
+        channel.close()
+        return "".join(stdout).splitlines(True), "".join(stderr).splitlines(True), exit_status
+
+    def exec_command(self, cmd, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        channel = self._open(cmd)
+        return self._collect(channel, cmd, deadline)
+
+    # Runs the commands concurrently, each one in its own channel. Results are returned
+    # in the same order as the commands.
+    def exec_commands(self, cmds, timeout=None):
+        results = []
+        for i in range(0, len(cmds), self.MAX_CHANNELS):
+            batch = cmds[i:i+self.MAX_CHANNELS]
+            deadline = None if timeout is None else time.time() + timeout
+            channels = [self._open(cmd) for cmd in batch]
+            try:
+                for channel, cmd in zip(channels, batch):
+                    results.append(self._collect(channel, cmd, deadline))
+            finally:
+                for channel in channels:
+                    channel.close()
+        return results
+
+
+class LocalCommandExecuter(CommandExecuter):
+    def __init__(self, shell="bash", unalias=()):
+        CommandExecuter.__init__(self, None, shell, unalias)
+
+    def _open(self, cmd):
+        return subprocess.Popen(self._wrap(cmd), shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _collect(self, proc, cmd, deadline=None):
+        timer = None
+        if deadline is not None:
+            timer = threading.Timer(max(0, deadline - time.time()), proc.kill)
+            timer.start()
+        try:
+            stdout, stderr = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if timer is not None and time.time() >= deadline and proc.returncode < 0:
+            raise CmdTimeout("Command '%s' timed out." % cmd)
+        return stdout.splitlines(True), stderr.splitlines(True), proc.returncode
+
+    # Processes run concurrently, so there is no need for batches
+    def exec_commands(self, cmds, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        procs = [self._open(cmd) for cmd in cmds]
+        return [self._collect(proc, cmd, deadline) for proc, cmd in zip(procs, cmds)]
 
 
 class CmdExecutionError(Exception):
@@ -70,6 +164,9 @@ class CmdExecutionError(Exception):
 class ConnectionTimeout(Exception):
     pass
 
+class CmdTimeout(Exception):
+    pass
+
 class Remote():
     def __init__(self, name="", workdir=None, hostname=None,\
             port=22, user=None, ssh_key_file=None, shell="bash",\
@@ -84,6 +181,11 @@ class Remote():
         self.workdir = workdir
         self.shell = shell
         self.resource_manager = resource_manager
+        self.jobs_commands = {}
+        self.compression = None
+        self.python = "python"
+        self.paramate = "paramate"
+        self.transfer = {"streams": 1, "connections": 1, "chunk-size": 64, "verify": True, "resume": False}
         self.ssh = SSHClient()
         try:
             self.ssh.load_system_host_keys()
@@ -91,6 +193,9 @@ class Remote():
             pass
         self.command_status = None
         self.scp = None
+        self._extra_ssh = []
+        self._passwd = None
+        self._timeout = None
         self._progress_callback = None
         self.cmd = None
         self.auth_type = "password"
@@ -165,6 +270,14 @@ class Remote():
             self.shell = yaml_remote["shell"]
         if "jobs-commands" in yaml_remote.keys():
             self.jobs_commands = yaml_remote["jobs-commands"]
+        if "compression" in yaml_remote.keys():
+            self.compression = yaml_remote["compression"]
+        if "python" in yaml_remote.keys():
+            self.python = yaml_remote["python"]
+        if "paramate" in yaml_remote.keys():
+            self.paramate = yaml_remote["paramate"]
+        if "transfer" in yaml_remote.keys():
+            self.transfer.update(yaml_remote["transfer"])
 
 
     def available(self, timeout=60):
@@ -187,51 +300,44 @@ class Remote():
             raise Exception("Directory %s already exists in remote '%s'." % (self.workdir, self.name))
         cmd_not_available = False
         _printer.print_msg("Checking remote dependencies...")
-        if not self.cmd_avail("qsub"):
-            _printer.print_msg("Warning: Command 'qsub' not available in '%s'." % self.name, ignore_quiet=True)
-            cmd_not_available = True 
-        if not self.cmd_avail("qstat"):
-            _printer.print_msg("Warning: Command 'qstat' not available in '%s'." % self.name, ignore_quiet=True)
-            cmd_not_available = True 
-        if not self.cmd_avail("qdel"):
-            _printer.print_msg("Warning: Command 'qdel' not available in '%s'." % self.name, ignore_quiet=True)
-            cmd_not_available = True 
+        scheduler_cmds = [cmd.split()[0] for cmd in get_scheduler(self).commands.values()]
+        for cmd in sorted(scheduler_cmds):
+            if not self.cmd_avail(cmd):
+                _printer.print_msg("Warning: Command '%s' not available in '%s'." % (cmd, self.name), ignore_quiet=True)
+                cmd_not_available = True 
         if cmd_not_available:
             _printer.print_msg("Info: Sometimes it is necessary to add the path where the\n" +\
-                  "      binaries qsub/qstat/qdel are located in the remote to the\n" +\
+                  "      binaries %s are located in the remote to the\n" % "/".join(sorted(scheduler_cmds)) +\
                   "      ~/.bashrc or ~/.cshrc files.", ignore_quiet=True)
 
+    def _connect_client(self, ssh, passwd=None, timeout=None):
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(self.hostname, port=self.port, password=passwd, timeout=timeout, username=self.user,\
+                    key_filename=self.ssh_key_file, look_for_keys=self.lookup_keys)
+
     def connect(self, passwd=None, timeout=None, progress_callback=None):
         self._progress_callback = progress_callback
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.ssh.connect(self.hostname, port=self.port, password=passwd, timeout=timeout, username=self.user,\
-                         key_filename=self.ssh_key_file, look_for_keys=self.lookup_keys)
+        self._connect_client(self.ssh, passwd, timeout)
+        # Kept to open extra connections for parallel transfers
+        self._passwd = passwd
+        self._timeout = timeout
         self.scp = SCPClient(self.ssh.get_transport(), socket_timeout=60.0, progress=self._progress_callback)
-        self.cmd = CommandExecuter(self.ssh)
         # Unalias all the commands to avoid unexpected behaviour
-        for remote_cmd in self.remote_linux_commands:
-            cmd = "unalias {}".format(remote_cmd)
-            self.command(cmd, timeout=60, fail_on_error=False)
-
-    # def command(self, cmd, timeout=None, fail_on_error=True):
-    #     stdin, stdout, stderr = self.ssh.exec_command(cmd, timeout=timeout)
-    #     self.command_status = stdout.channel.recv_exit_status()
-    #     self.command_status = stdout.channel.recv_exit_status()
-    #     if fail_on_error:
-    #         if self.command_status != 0:
-    #             error = stderr.readlines()
-    #             raise CmdExecutionError("".join([l for l in error if l]))
-    #     return stdout.readlines()
+        self.cmd = CommandExecuter(self.ssh, self.shell, self.remote_linux_commands)
 
     def command(self, cmd, timeout=None, fail_on_error=True):
-        stdin, stdout, stderr, exit_status = self.cmd.exec_command(cmd)
+        stdout, stderr, exit_status = self.cmd.exec_command(cmd, timeout)
         self.command_status = exit_status
         if fail_on_error:
             if self.command_status != 0:
-                error = stderr
+                error = stderr if stderr else stdout
                 raise CmdExecutionError("".join([l for l in error if l]))
         return stdout
 
+    # Run several independent commands at once. Returns a list of (stdout, stderr, exit status).
+    def commands(self, cmds, timeout=None):
+        return self.cmd.exec_commands(cmds, timeout)
+
     def cmd_avail(self, cmd_name): 
         try:
             output = self.command("which  %s" % cmd_name, timeout=60)
@@ -239,22 +345,62 @@ class Remote():
             return False
         return True
     
+    def _transports(self):
+        while len(self._extra_ssh) < self.transfer["connections"] - 1:
+            ssh = SSHClient()
+            try:
+                ssh.load_system_host_keys()
+            except:
+                pass
+            self._connect_client(ssh, self._passwd, self._timeout)
+            self._extra_ssh.append(ssh)
+        return [self.ssh.get_transport()] + [ssh.get_transport() for ssh in self._extra_ssh]
+
+    def _transfer_engine(self):
+        return TransferEngine(self._transports(), streams=self.transfer["streams"],
+                              chunk_size=self.transfer["chunk-size"]*1024*1024,
+                              progress_callback=self._progress_callback,
+                              resume=self.transfer["resume"])
+
+    # Transfers through the engine (SFTP) are split in chunks and can be resumed,
+    # otherwise (one stream and resume not enabled) scp is used.
+    def parallel_transfer(self):
+        return self.transfer["streams"] > 1 or self.transfer["resume"]
+
+    def verify_transfer(self, local_path, remote_path):
+        output = self.command("sha1sum %s" % remote_path)
+        remote_hash = output[0].split()[0] if output else None
+        if remote_hash != file_digest(local_path):
+            raise Exception("Checksum of '%s' differs between local and remote '%s'." % (os.path.basename(local_path), self.name))
+
     def upload(self, path_orig, path_dest):
-        self.scp.put(path_orig, path_dest)
+        if self.parallel_transfer():
+            remote_path = os.path.join(path_dest, os.path.basename(path_orig))
+            self._transfer_engine().upload([(path_orig, remote_path)])
+            if self.transfer["verify"]:
+                self.verify_transfer(path_orig, remote_path)
+        else:
+            self.scp.put(path_orig, path_dest)
 
     def download(self, path_orig, path_dest):
-        self.scp.get(path_orig, path_dest)
+        if self.parallel_transfer():
+            local_path = os.path.join(path_dest, os.path.basename(path_orig))
+            self._transfer_engine().download([(path_orig, local_path)])
+            if self.transfer["verify"]:
+                self.verify_transfer(local_path, path_orig)
+        else:
+            self.scp.get(path_orig, path_dest)
 
     def remote_file_exists(self, f):
         try:
-            out = self.command("[ -f %s ]" % f)
+            out = self.command("[ -f %s ]" % f, timeout=60)
         except CmdExecutionError:
             return False
         return True
 
     def remote_dir_exists(self, d):
         try:
-            out = self.command("[ -d %s ]" % d)
+            out = self.command("[ -d %s ]" % d, timeout=60)
         except CmdExecutionError:
             return False
         return True
@@ -263,8 +409,65 @@ class Remote():
     def close(self):
         if self.scp is not None:
             self.scp.close()
+        for ssh in self._extra_ssh:
+            ssh.close()
+        self._extra_ssh = []
         self.ssh.close()
 
+# Remote for the 'local' resource manager. The work directory is on this machine,
+# commands run in local processes and transfers are plain copies.
+class LocalRemote(Remote):
+    def __init__(self, name="", workdir=None, shell="bash", resource_manager="local"):
+        Remote.__init__(self, name=name, workdir=workdir, hostname="localhost", shell=shell,
+                        resource_manager=resource_manager)
+        self.auth_type = None
+        self.local_resources = {}
+        self.python = sys.executable
+        self.paramate = "%s %s" % (sys.executable, os.path.join(SRC_DIR, "__main__.py"))
+
+    def configure(self, remote_name, yaml_remote):
+        self.name = remote_name
+        self.workdir = os.path.normpath(os.path.expanduser(yaml_remote["remote-workdir"]))
+        self.resource_manager = yaml_remote["resource-manager"]
+        if "shell" in yaml_remote.keys():
+            self.shell = yaml_remote["shell"]
+        if "jobs-commands" in yaml_remote.keys():
+            self.jobs_commands = yaml_remote["jobs-commands"]
+        if "compression" in yaml_remote.keys():
+            self.compression = yaml_remote["compression"]
+        if "python" in yaml_remote.keys():
+            self.python = yaml_remote["python"]
+        if "paramate" in yaml_remote.keys():
+            self.paramate = yaml_remote["paramate"]
+        if "local-resources" in yaml_remote.keys():
+            self.local_resources = yaml_remote["local-resources"]
+
+    def available(self, timeout=60):
+        pass
+
+    def connect(self, passwd=None, timeout=None, progress_callback=None):
+        self._progress_callback = progress_callback
+        self.cmd = LocalCommandExecuter(self.shell)
+
+    def parallel_transfer(self):
+        return False
+
+    def _copy(self, path_orig, path_dest):
+        shutil.copy(path_orig, path_dest)
+        if self._progress_callback is not None:
+            size = os.path.getsize(path_orig)
+            self._progress_callback(os.path.basename(path_orig), size, size)
+
+    def upload(self, path_orig, path_dest):
+        self._copy(path_orig, path_dest)
+
+    def download(self, path_orig, path_dest):
+        self._copy(path_orig, path_dest)
+
+    def close(self):
+        pass
+
+
 class RemoteDirExists(Exception):
     pass
 
@@ -277,40 +480,123 @@ class StudyManager():
         self.tmpdir = "/tmp"
         self.study = study
      
-    def _upload(self, remote, name, base_path, upload_cases, keep_targz=False, force=False):
+    def _upload(self, remote, name, base_path, upload_cases, keep_targz=False, force=False, dedup=False):
         if not remote.remote_dir_exists(remote.workdir):
             raise Exception("Remote work directory '%s' do not exists. Use 'remote-init' command to create it." % remote.workdir)
         remotedir = os.path.join(remote.workdir, name)
         _printer.print_msg("Checking remote state...")
-        for case in upload_cases:
-            remote_casedir = os.path.join(remotedir, case)
-            if remote.remote_dir_exists(remote_casedir) and not force:
-                raise RemoteDirExists("Study '%s' - Case directory '%s' already exists in remote '%s'."\
-                                      % (self.study.name, case, remote.name))
-        upload_files = upload_cases + self.DEFAULT_UPLOAD_FILES
-        _printer.print_msg("Compressing study...")
-        tar_name = self._compress(name, base_path, upload_files)
+        if not force:
+            checks = remote.commands(["[ -d %s ]" % os.path.join(remotedir, case) for case in upload_cases], timeout=60)
+            for case, (stdout, stderr, exit_status) in zip(upload_cases, checks):
+                if exit_status == 0:
+                    raise RemoteDirExists("Study '%s' - Case directory '%s' already exists in remote '%s'."\
+                                          % (self.study.name, case, remote.name))
+        content_index = None
+        store_keys = set()
+        if dedup:
+            _printer.print_msg("Indexing case files...")
+            content_index = ContentIndex(base_path)
+            for path in upload_cases:
+                content_index.add(path)
+            store_keys = self._remote_store_keys(remote)
+            new_keys = content_index.keys() - store_keys
+            _printer.print_msg("Found %d files with %d distinct contents (%d already in remote store)."\
+                               % (len(content_index.files), len(content_index.keys()),
+                                  len(content_index.keys()) - len(new_keys)))
+            upload_files = list(self.DEFAULT_UPLOAD_FILES)
+        else:
+            upload_files = upload_cases + self.DEFAULT_UPLOAD_FILES
+        codec = self._codec(remote)
+        tar_name = name + codec.ext
         upload_src = os.path.join(self.tmpdir, tar_name)
+        key_path = upload_src + ARCHIVE_KEY_SUFFIX
+        archive_key = None
+        # The archive left by an interrupted upload is reused if the files did not change.
+        # Hashing the files is only worth it with resumable transfers or deduplication.
+        if dedup or remote.transfer["resume"]:
+            archive_key = self._archive_key(self._local_manifest(base_path, upload_files), codec.name,
+                                            sorted(content_index.files) if dedup else None, sorted(store_keys))
+        if archive_key is not None and self._local_archive_key(upload_src, key_path) == archive_key:
+            _printer.print_msg("Archive unchanged. Skipping compression...")
+        else:
+            _printer.print_msg("Compressing study...")
+            if os.path.exists(key_path):
+                os.remove(key_path)
+            self._compress(name, base_path, upload_files, content_index, store_keys, codec)
+            if archive_key is not None:
+                with open(key_path, 'w') as key_file:
+                    key_file.write(archive_key)
         upload_dest = remote.workdir
         remote.upload(upload_src, upload_dest)
         extract_src = os.path.join(upload_dest, tar_name)
         extract_dest = upload_dest
         _printer.print_msg("Extracting study in remote...")
         try:
-            out = remote.command("tar -xzf %s --directory %s --warning=no-timestamp" % (extract_src, extract_dest))
+            out = remote.command("tar %s -xf %s --directory %s --warning=no-timestamp" % (codec.tar_flags(), extract_src, extract_dest))
             # For older versions of tar. Not sure how they will handle the timestamp issue though.
         except Exception as error:
             try:
-                out = remote.command("tar -xzf %s --directory %s" % (extract_src, extract_dest))
+                out = remote.command("tar %s -xf %s --directory %s" % (codec.tar_flags(), extract_src, extract_dest))
             except Exception:
-                raise Exception("Unable to decompress '%s.tar.gz' in remote. Check version of 'tar' command in the remote." % tar_name)
+                raise Exception("Unable to decompress '%s' in remote. Check version of 'tar' command in the remote." % tar_name)
+        if dedup:
+            _printer.print_msg("Linking case files from remote store...")
+            links_script = os.path.join(name, LINKS_SCRIPT_NAME)
+            remote.command("cd %s && sh %s && rm -f %s" % (extract_dest, links_script, links_script))
         _printer.print_msg("Cleaning...")
         os.remove(upload_src)
+        if os.path.exists(key_path):
+            os.remove(key_path)
         if not keep_targz:
             out = remote.command("rm -f %s" % extract_src)
 
     
-    def upload(self, remote, array_job=False, keep_targz=False, force=False):
+    # Small files are hashed, as 'cases.info' is rewritten before every upload
+    def _local_manifest(self, base_path, paths, hash_size=1024*1024):
+        manifest = []
+        for path in paths:
+            abs_path = os.path.join(base_path, path)
+            walk = os.walk(abs_path) if os.path.isdir(abs_path) else [(os.path.dirname(abs_path), [], [os.path.basename(abs_path)])]
+            for root, dirnames, filenames in walk:
+                for f in sorted(filenames):
+                    f_path = os.path.join(root, f)
+                    if not os.path.isfile(f_path):
+                        continue
+                    f_stat = os.stat(f_path)
+                    if f_stat.st_size < hash_size:
+                        manifest.append((os.path.relpath(f_path, base_path), file_digest(f_path)))
+                    else:
+                        manifest.append((os.path.relpath(f_path, base_path), f_stat.st_size, int(f_stat.st_mtime)))
+        return manifest
+
+    def _local_archive_key(self, archive_path, key_path):
+        if not os.path.exists(archive_path):
+            return None
+        try:
+            with open(key_path, 'r') as key_file:
+                return key_file.read().strip()
+        except IOError:
+            return None
+
+    # Fall back to gzip if the codec program is missing in any of both ends
+    def _codec(self, remote):
+        codec = Codec.from_config(remote.compression)
+        if codec.name == DEFAULT_CODEC:
+            return codec
+        if not codec.local_available():
+            _printer.print_msg("Codec '%s' not available locally. Using '%s'." % (codec.name, DEFAULT_CODEC), "warning")
+            return Codec(DEFAULT_CODEC)
+        if not codec.remote_available(remote):
+            _printer.print_msg("Codec '%s' not available in remote '%s'. Using '%s'." % (codec.name, remote.name, DEFAULT_CODEC), "warning")
+            return Codec(DEFAULT_CODEC)
+        return codec
+
+    def _remote_store_keys(self, remote):
+        store_dir = os.path.join(remote.workdir, STORE_DIRNAME)
+        output = remote.command("mkdir -p %s && ls -1 %s" % (store_dir, store_dir), timeout=60)
+        return set([line.strip() for line in output if line.strip()])
+
+    def upload(self, remote, array_job=False, keep_targz=False, force=False, dedup=False, generate=False):
         params = {"PARAMATE-CD": "",
                   "PARAMATE-CN": "", 
                   "PARAMATE-RWD": remote.workdir, 
@@ -321,21 +607,17 @@ class StudyManager():
         template_script_path = os.path.join(self.study.path, "submit.%s.sh" % remote.name)
         submit_script_path = ""
         upload_cases = self.study.case_selection
+        if generate and dedup:
+            raise Exception("Options 'generate' and 'dedup' cannot be used together.")
 
         # Create submission scripts
         if os.path.exists(template_script_path):
             if array_job:
-                submit_script_path = os.path.join(self.study.path, "submit_arrayjob.sh")
-                shutil.copy(template_script_path, submit_script_path)
-                remote_study_path = os.path.join(remote.workdir, self.study.name)
-                params["PARAMATE-CN"] = "$(python %s/manage.py case-param $PBS_ARRAY_INDEX name)" % remote_study_path
-                params["PARAMATE-CD"] = os.path.join(self.study.path, params["PARAMATE-CN"])
-                try:
-                    replace_placeholders([submit_script_path], params)
-                except Exception:
-                    os.remove(submit_script_path)
-                    raise
-            for case in upload_cases:
+                self._write_array_cases(upload_cases)
+                self._create_array_script(remote, os.path.join(self.study.path, "submit_arrayjob.sh"),
+                                          "arrayjob.cases")
+            # Generated cases get their submission script in the remote
+            for case in upload_cases if not generate else []:
                 case_path = os.path.join(self.study.path, case.name)
                 submit_script_path = os.path.join(case_path, "submit.sh")
                 shutil.copy(template_script_path, submit_script_path)
@@ -360,25 +642,149 @@ class StudyManager():
         # Modify the study file so it is uploaded updated.
         try:
             self.study.save()
+            if generate:
+                self._upload_generate(remote, upload_cases, array_job, keep_targz, force)
+                return
             upload_paths = [case.name for case in upload_cases]
             if array_job:
-                upload_paths.append("submit_arrayjob.sh")
+                upload_paths.extend(["submit_arrayjob.sh", "arrayjob.cases"])
 
-            self._upload(remote, self.study.name, self.study.path, upload_paths, keep_targz, force)
+            self._upload(remote, self.study.name, self.study.path, upload_paths, keep_targz, force, dedup)
         except Exception:
             self.study.study_file.restore(self.tmpdir)
             raise
 
+    def _write_array_cases(self, cases):
+        array_cases_path = os.path.join(self.study.path, "arrayjob.cases")
+        with open(array_cases_path, 'w') as array_cases_file:
+            array_cases_file.writelines([case.name + "\n" for case in cases])
+        return array_cases_path
+
+    # Only the template and the study files are sent. The cases are generated by
+    # paramate in the remote and its 'cases.info' is reconciled with the local one.
+    def _upload_generate(self, remote, upload_cases, array_job, keep_targz, force):
+        remote_studydir = os.path.join(remote.workdir, self.study.name)
+        case_names = [case.name for case in upload_cases]
+        if not force:
+            checks = remote.commands(["[ -d %s ]" % os.path.join(remote_studydir, name) for name in case_names], timeout=60)
+            for name, (stdout, stderr, exit_status) in zip(case_names, checks):
+                if exit_status == 0:
+                    raise RemoteDirExists("Study '%s' - Case directory '%s' already exists in remote '%s'."\
+                                          % (self.study.name, name, remote.name))
+        upload_paths = ["template", "remotes.yaml", "submit.%s.sh" % remote.name]
+        if array_job:
+            upload_paths.extend(["submit_arrayjob.sh", "arrayjob.cases"])
+        self._upload(remote, self.study.name, self.study.path, upload_paths, keep_targz, force=True)
+        self._upload_file_list(remote, remote_studydir, [str(case.id) for case in upload_cases], GENERATE_IDS_NAME)
+        generate_cmd = "cd %s && " % remote_studydir
+        if force:
+            list_path = self._upload_file_list(remote, remote_studydir, case_names, ".paramate-generate.list")
+            generate_cmd += "tr '\\n' '\\0' < %s | xargs -0 rm -rf && rm -f %s && " % (list_path, list_path)
+        generate_cmd += "%s generate --local-remote %s --ids-file %s" % (remote.paramate, remote.name, GENERATE_IDS_NAME)
+        if any([case.short_name for case in upload_cases]):
+            generate_cmd += " --shortname"
+        _printer.print_msg("Generating %d cases in remote..." % len(upload_cases))
+        try:
+            remote.command(generate_cmd)
+        finally:
+            remote.command("rm -f %s" % os.path.join(remote_studydir, GENERATE_IDS_NAME), fail_on_error=False)
+        self._reconcile_generated(remote, upload_cases)
+        self.study.save()
+        # The remote keeps the same 'cases.info' as after a regular upload
+        remote.upload(os.path.join(self.study.path, "cases.info"), remote_studydir)
+        if array_job:
+            remote.upload(self._write_array_cases(upload_cases), remote_studydir)
+
+    def _reconcile_generated(self, remote, upload_cases):
+        info_dir = tempfile.mkdtemp(dir=self.tmpdir)
+        try:
+            remote.download(os.path.join(remote.workdir, self.study.name, "cases.info"), info_dir)
+            with open(os.path.join(info_dir, "cases.info"), 'r') as info_file:
+                info = json.load(info_file)
+        finally:
+            shutil.rmtree(info_dir)
+        generated = {}
+        for case_dict in info["cases"]:
+            case = Case()
+            case.init_from_dict(case_dict)
+            generated[case.id] = case
+        nof_changed = 0
+        for case in upload_cases:
+            remote_case = generated.get(case.id)
+            if remote_case is None or remote_case.status != "UPLOADED":
+                raise Exception("Case '%s' was not generated in remote '%s'." % (case.name, remote.name))
+            # Generators do not necessarily give the same values in the remote
+            if (remote_case.name, remote_case.params, remote_case.singleval_params) !=\
+               (case.name, case.params, case.singleval_params):
+                case.name = remote_case.name
+                case.params = remote_case.params
+                case.singleval_params = remote_case.singleval_params
+                nof_changed += 1
+        if nof_changed:
+            _printer.print_msg("%d cases generated in remote '%s' with different parameters. Updated 'cases.info'."\
+                               % (nof_changed, remote.name), "warning")
+
 
-    def _compress(self, name, base_path, upload_paths):
-        tar_name = name + ".tar.gz"
-        with tarfile.open(os.path.join(self.tmpdir, tar_name), "w:gz") as tar:
+    # The array index of each element is mapped to a case name through the line
+    # of 'cases_list' (relative to the remote study directory).
+    def _create_array_script(self, remote, script_path, cases_list):
+        scheduler = get_scheduler(remote)
+        remote_study_path = os.path.join(remote.workdir, self.study.name)
+        case_name = "$(sed -n \"$((${%s}-%d+1))p\" %s)" % (scheduler.ARRAY_INDEX_VAR, scheduler.ARRAY_FIRST_INDEX,
+                                                          os.path.join(remote_study_path, cases_list))
+        params = {"PARAMATE-CN": case_name,
+                  "PARAMATE-CD": os.path.join(remote_study_path, case_name),
+                  "PARAMATE-RWD": remote.workdir,
+                  "PARAMATE-REMOTE": remote.name,
+                  "PARAMATE-LWD": os.path.dirname(self.study.path),
+                  "PARAMATE-SN": self.study.name,
+                  "PARAMATE-SD": self.study.path}
+        template_script_path = os.path.join(self.study.path, "submit.%s.sh" % remote.name)
+        if not os.path.exists(template_script_path):
+            raise Exception("Submission script 'submit.%s.sh' not found in study directory." % remote.name)
+        shutil.copy(template_script_path, script_path)
+        try:
+            replace_placeholders([script_path], params)
+        except Exception:
+            os.remove(script_path)
+            raise
+
+    def _compress(self, name, base_path, upload_paths, content_index=None, store_keys=(), codec=None):
+        if codec is None:
+            codec = Codec()
+        tar_name = name + codec.ext
+        with codec.open_local(os.path.join(self.tmpdir, tar_name), "w") as tar:
             for path in upload_paths:
                 tar.add(os.path.join(base_path, path), arcname=os.path.join(name, path))
+            if content_index is not None:
+                self._add_deduplicated(tar, name, content_index, store_keys)
         return tar_name
 
-    def _decompress(self, src_path, dest_path):
-        with tarfile.open(src_path, "r:gz") as tar:
+    # Directories and non-regular files go as they are, regular files are sent once per
+    # distinct content into the remote store and linked or copied afterwards by the links script.
+    def _add_deduplicated(self, tar, name, content_index, store_keys):
+        for path in content_index.dirs:
+            tar.add(os.path.join(content_index.base_path, path), arcname=os.path.join(name, path),
+                    recursive=False)
+        for path in content_index.others:
+            tar.add(os.path.join(content_index.base_path, path), arcname=os.path.join(name, path),
+                    recursive=False)
+        for key, src_path in sorted(content_index.sources.items()):
+            if key not in store_keys:
+                tar.add(src_path, arcname=os.path.join(STORE_DIRNAME, key))
+        script = content_index.links_script(name)
+        if not isinstance(script, bytes):
+            script = script.encode("utf-8")
+        script_info = tarfile.TarInfo(os.path.join(name, LINKS_SCRIPT_NAME))
+        script_info.size = len(script)
+        script_info.mtime = time.time()
+        script_info.mode = 0o644
+        tar.addfile(script_info, io.BytesIO(script))
+
+    def _decompress(self, src_path, dest_path, codec=None):
+        if codec is None:
+            codec = Codec()
+        with codec.open_local(src_path, "r") as tar:
             tar.extractall(dest_path)
         
     def _cases_regexp(self):
@@ -400,33 +806,89 @@ class StudyManager():
             error += "NOTE: Sometimes NFS filesystems take a while to syncronise.\n" +\
                      "      If you are sure the study is uploaded, wait a bit and retry submission."
             raise Exception(error)
-        if not remote.cmd_avail("qsub"):
-            raise Exception("Command 'qsub' not available in remote '%s'." % remote.name)
+        scheduler = get_scheduler(remote)
+        submit_cmd = scheduler.commands["submit"]
+        if not remote.cmd_avail(submit_cmd.split()[0]):
+            raise Exception("Command '%s' not available in remote '%s'." % (submit_cmd, remote.name))
+        # Single-element arrays are rejected by some managers (PBS Pro)
+        if array_job and len(self.study.case_selection) == 1:
+            _printer.print_msg("Only one case selected. Submitting it as a regular job.", "warning")
+            array_job = False
         if array_job:
-           pass
+            return self._array_submit(remote, remote_studydir, scheduler)
         else:
-            nof_submitted = 0
-            # awk_cmd = "awk 'match($0,/[0-9]+/){print substr($0, RSTART, RLENGTH)}'"
-            for case in self.study.case_selection:
-                try:
-                    remote_casedir = os.path.join(remote_studydir, case.name)
-                    output = remote.command("cd {} && qsub submit.sh".format(remote_casedir), timeout=10)
-                except Exception as err:
-                    # Save if some jobs has been submitted before the error
-                    self.study.save()
-                    raise Exception("While submitting case '{}': '{}'.".format(case.id, str(err).replace('\n', '')))
-                try:
-                    case.job_id = self._extract_job_id(output, case.id)
-                    # print "out:", output, case.job_id
-                    case.status = "SUBMITTED"
-                    case.submission_date = time.strftime("%c")
-                    nof_submitted += 1
-                    _printer.print_msg("Submitted case '%s' (%d/%d)." % (case.name, nof_submitted, len(self.study.case_selection)))
-                except Exception as err:
-                    # Save if some jobs has been submitted before the error
-                    self.study.save()
-                    raise
-            self.study.save()
+            return self._bulk_submit(remote, remote_studydir, submit_cmd)
+
+    # Submit the selection as one array job. Each submission gets its own script and
+    # cases list so elements of previous arrays still in the queue are not affected.
+    def _array_submit(self, remote, remote_studydir, scheduler):
+        cases = self.study.case_selection
+        tag = time.strftime("%Y%m%d%H%M%S")
+        cases_list = "arrayjob.%s.cases" % tag
+        script_name = "submit_arrayjob.%s.sh" % tag
+        script_path = os.path.join(self.tmpdir, script_name)
+        self._create_array_script(remote, script_path, cases_list)
+        try:
+            remote.upload(script_path, remote_studydir)
+        finally:
+            os.remove(script_path)
+        self._upload_file_list(remote, remote_studydir, [case.name for case in cases], cases_list)
+        _printer.print_msg("Submitting array job of %d cases..." % len(cases))
+        output = remote.command("cd %s && %s" % (remote_studydir, scheduler.array_submit_command(script_name, len(cases))),
+                                timeout=60)
+        array_job_id = self._extract_job_id(output)
+        submission_date = time.strftime("%c")
+        job_ids = {}
+        for index, case in enumerate(cases):
+            case.job_id = scheduler.array_element_id(array_job_id, index + scheduler.ARRAY_FIRST_INDEX)
+            case.array_job_id = array_job_id
+            case.status = "SUBMITTED"
+            case.submission_date = submission_date
+            job_ids[case.name] = case.job_id
+        self.study.save()
+        _printer.print_msg("Submitted array job '%s' with %d elements." % (array_job_id, len(cases)))
+        return job_ids
+
+    # Submit all the selected cases with a single remote script. Returns a dict mapping
+    # case names to job ids. Failed submissions are reported per case.
+    def _bulk_submit(self, remote, remote_studydir, submit_cmd):
+        script = BULK_SUBMIT_SCRIPT.format(submit=submit_cmd,
+                                           cases="\n".join([case.name for case in self.study.case_selection]))
+        script_path = self._upload_text(remote, remote_studydir, ".paramate-submit.sh", script)
+        _printer.print_msg("Submitting %d cases..." % len(self.study.case_selection))
+        output = remote.command("cd %s && sh %s ; rm -f %s" % (remote_studydir, script_path, script_path),
+                                fail_on_error=False)
+        responses = {}
+        for line in output:
+            fields = line.rstrip("\n").split("\t", 2)
+            if len(fields) == 3:
+                responses[fields[0]] = fields[1:]
+        job_ids = {}
+        errors = {}
+        for case in self.study.case_selection:
+            try:
+                status, response = responses[case.name]
+            except KeyError:
+                errors[case.name] = "No response from submission script."
+                continue
+            if status != "0":
+                errors[case.name] = response.strip()
+                continue
+            try:
+                case.job_id = self._extract_job_id([response], case.id)
+            except Exception as err:
+                errors[case.name] = str(err)
+                continue
+            case.status = "SUBMITTED"
+            case.submission_date = time.strftime("%c")
+            job_ids[case.name] = case.job_id
+        self.study.save()
+        _printer.print_msg("Submitted %d/%d cases." % (len(job_ids), len(self.study.case_selection)))
+        for case_name, error in sorted(errors.items()):
+            _printer.print_msg("Case '%s' not submitted: %s" % (case_name, error), "warning", ignore_quiet=True)
+        if errors:
+            raise Exception("%d cases could not be submitted." % len(errors))
+        return job_ids
 
     def _extract_job_id(self, output, case_id=None):
         id_extracted = True
@@ -448,58 +910,102 @@ class StudyManager():
 
 
     def update_status(self, remote):
-        if not remote.cmd_avail("qstat"):
-            raise Exception("Command 'qstat' not available in remote '%s'." % remote.name)
-        awk = "awk 'match($0,/[0-9]+/){print substr($0, RSTART, RLENGTH)}'"
-        output = remote.command("qstat | {}".format(awk), timeout=60)
-        job_ids  = [self._extract_job_id([line]) for line in output]
+        scheduler = get_scheduler(remote)
+        status_cmd = scheduler.commands["status"]
+        if not remote.cmd_avail(status_cmd.split()[0]):
+            raise Exception("Command '%s' not available in remote '%s'." % (status_cmd, remote.name))
         remote_case_list = self.study.get_cases([remote.name], "remote")
-        for case in remote_case_list:
-            if not (case.job_id in job_ids) and case.status == "SUBMITTED":
+        submitted_cases = [c for c in remote_case_list if c.status == "SUBMITTED" and c.job_id is not None]
+        if not submitted_cases:
+            return []
+        states = scheduler.query(remote, [c.job_id for c in submitted_cases])
+        active_job_ids = []
+        for case in submitted_cases:
+            case.job_state, case.exit_code = states[case.job_id]
+            if case.job_state in ACTIVE_STATES:
+                active_job_ids.append(case.job_id)
+            elif case.job_state == FAILED:
+                case.status = "FAILED"
+            else:
                 case.status = "FINISHED"
-        self.study.save()
-        # return jobs_updated
-        return job_ids
+        # The monitor updates the states next to other commands
+        self.study.save_job_states(submitted_cases)
+        return active_job_ids
 
-    def job_status(self, remote):
-        if not remote.cmd_avail("qstat"):
-            raise Exception("Command 'qstat' not available in remote '%s'." % remote.name)
-        awk = "awk 'match($0,/[0-9]+/){print substr($0, RSTART, RLENGTH)}'"
-        output = remote.command("qstat | %s" % awk, timeout=60)
-        job_ids  = [jid.rstrip() for jid in output]
-        output = remote.command("qstat", timeout=60)
-        selected_cases_idx = [case.job_id for case in self.study.case_selection]
-        filter_idx = [job_ids.index(jid) for jid in job_ids if jid in selected_cases_idx]
-        header_lines = 2
-        filtered_output = [output[j+header_lines] for j in filter_idx]
-        filtered_output.insert(0, output[0])
-        filtered_output.insert(1, output[1])
-        return filtered_output
-
-    def job_delete(self, remote):
-        if not remote.cmd_avail("qdel"):
-            raise Exception("Command 'qdel' not available in remote '%s'." % remote.name)
-        jobid_list_str = " ".join([c.job_id for c in self.study.case_selection])
-        # print "jobids:", jobid_list_str
-        output = remote.command("qdel {}".format(jobid_list_str), timeout=60)
-        while self.update_status(remote):
-            time.sleep(1)
+    # Job states are refreshed by update_status()
+    def job_status(self, remote, refresh=True):
+        if refresh:
+            self.update_status(remote)
+        cases = sorted(self.study.case_selection, key=lambda c: c.id)
+        fmt = "{:<16} {:<10} {:<6} {}\n"
+        output = [fmt.format("Job id", "State", "Exit", "Case")]
+        for case in cases:
+            exit_code = case.exit_code if case.exit_code is not None else "-"
+            output.append(fmt.format(case.job_id, case.job_state, exit_code, case.name))
+        return output
+
+    def job_delete(self, remote, timeout=600):
+        scheduler = get_scheduler(remote)
+        delete_cmd = scheduler.commands["delete"]
+        if not remote.cmd_avail(delete_cmd.split()[0]):
+            raise Exception("Command '%s' not available in remote '%s'." % (delete_cmd, remote.name))
+        job_ids = [c.job_id for c in self.study.case_selection if c.job_id is not None]
+        # Array element ids as '1234[5]' have to be quoted
+        quoted_ids = [pipes.quote(j) for j in job_ids]
+        cmds = ["{} {}".format(delete_cmd, " ".join(chunk))
+                for chunk in self._chunk_args(quoted_ids, MAX_CMD_LENGTH - len(delete_cmd))]
+        for cmd, (stdout, stderr, exit_status) in zip(cmds, remote.commands(cmds, timeout=60)):
+            # Jobs finishing meanwhile make the command fail
+            if exit_status != 0:
+                _printer.print_msg("Command '{}' failed: {}".format(cmd, "".join(stderr or stdout).strip()), "warning")
+        pending_ids = self._wait_jobs(remote, scheduler, job_ids, timeout)
+        if pending_ids:
+            _printer.print_msg("{} jobs still in the queue after {} seconds.".format(len(pending_ids), timeout), "warning")
         for case in self.study.case_selection:
-            case.status = "DELETED"
+            if case.job_id not in pending_ids:
+                case.status = "DELETED"
         self.study.save()
         # Return the number of cases marked for deletion
         return len(self.study.case_selection)
 
-    def download(self, remote, force=False, compress_only=False):
-        remote_studydir = os.path.join(remote.workdir, self.study.name)
-        if not remote.remote_dir_exists(remote_studydir):
-            raise Exception("Study '%s' does not exists in remote '%s'." % (self.study.name, remote.name))
-        compress_dirs = ""
+    @staticmethod
+    def _chunk_args(args, max_length):
+        chunks = []
+        chunk, length = [], 0
+        for arg in args:
+            if chunk and length + len(arg) + 1 > max_length:
+                chunks.append(chunk)
+                chunk, length = [], 0
+            chunk.append(arg)
+            length += len(arg) + 1
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    # Waits only for the given jobs, backing off between queries. Returns the
+    # ids still active when the timeout expires.
+    def _wait_jobs(self, remote, scheduler, job_ids, timeout):
+        deadline = time.time() + timeout
+        delay = 0.5
+        pending_ids = set(job_ids)
+        while pending_ids:
+            states = scheduler.query(remote, pending_ids)
+            pending_ids = set([j for j, (state, exit_code) in states.items() if state in ACTIVE_STATES])
+            if not pending_ids or time.time() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, 30)
+        return pending_ids
+
+    def _download_targets(self):
         cases_regexp = self._cases_regexp()
-        for path in self.study.param_file["DOWNLOAD"]:
-            include_list = []
-            exclude_list = []
-            path_name = path["path"]
+        try:
+            download_paths = self.study.param_file["DOWNLOAD"]
+        except KeyError:
+            download_paths = [{"path": d} for d in DEFAULT_DOWNLOAD_DIRS]
+        # List of (paths, exclude patterns) relative to the remote study directory
+        targets = []
+        for path in download_paths:
             # TODO: Move checks of params.yaml to the Sections checkers in PARAMATE.py
             include_exists = "include" in path
             exclude_exists = "exclude" in path
@@ -509,37 +1015,299 @@ class StudyManager():
                                 % path["path"])
             else:
                 if include_exists:
-                    include_list = [os.path.join(path_wildcard, f) for f in path["include"]]
-                    compress_dirs += " " + " ".join(include_list)
+                    targets.append(([os.path.join(path_wildcard, f) for f in path["include"]], []))
                 elif exclude_exists:
-                    exclude_list = path["exclude"]
-                    for f in exclude_list:
-                        compress_dirs += " --exclude=%s" % f
-                    compress_dirs += " " + path_wildcard
+                    targets.append(([path_wildcard], path["exclude"]))
+                else:
+                    targets.append(([path_wildcard], []))
+        return targets
+
+    # Returns {path: (size, mtime)} for the files to download, paths relative to the study directory
+    def _remote_manifest(self, remote, remote_studydir, targets):
+        find_cmds = []
+        for paths, excludes in targets:
+            prune = ""
+            if excludes:
+                prune = "\\( %s \\) -prune -o " % " -o ".join(["-name '%s'" % e for e in excludes])
+            find_cmds.append("find %s %s-type f -printf '%%p\\t%%s\\t%%T@\\n'" % (" ".join(paths), prune))
+        # Missing paths make 'find' fail, which would discard the output of the others
+        output = remote.command("cd %s && %s ; true" % (remote_studydir, " ; ".join(find_cmds)),
+                                fail_on_error=False)
+        manifest = {}
+        for line in output:
+            fields = line.rstrip("\n").split("\t")
+            # Skip error messages of paths not found
+            if len(fields) != 3:
+                continue
+            try:
+                manifest[os.path.normpath(fields[0])] = (int(fields[1]), int(float(fields[2])))
+            except ValueError:
+                continue
+        return manifest
+
+    def _local_changes(self, remote, remote_studydir, manifest, checksum=False):
+        changed = []
+        same_size = []
+        for path, (size, mtime) in sorted(manifest.items()):
+            local_path = os.path.join(self.study.path, path)
+            try:
+                local_stat = os.stat(local_path)
+            except OSError:
+                changed.append(path)
+                continue
+            if local_stat.st_size != size:
+                changed.append(path)
+            elif int(local_stat.st_mtime) != mtime:
+                same_size.append(path)
+        if not checksum:
+            return changed + same_size
+        # Only files with equal size and different modification time are hashed
+        if same_size:
+            remote_hashes = self._remote_checksums(remote, remote_studydir, same_size)
+            for path in same_size:
+                local_path = os.path.join(self.study.path, path)
+                if remote_hashes.get(path) == file_digest(local_path, algorithm="md5"):
+                    # Sync modification time so the file is not hashed again next time
+                    os.utime(local_path, (manifest[path][1], manifest[path][1]))
                 else:
-                    compress_dirs += " " + path_wildcard
+                    changed.append(path)
+        return changed
+
+    def _upload_file_list(self, remote, remote_studydir, paths, list_name):
+        return self._upload_text(remote, remote_studydir, list_name, "".join([p + "\n" for p in paths]))
+
+    def _upload_text(self, remote, remote_dir, name, text):
+        local_path = os.path.join(self.tmpdir, name)
+        with open(local_path, 'w') as text_file:
+            text_file.write(text)
+        try:
+            remote.upload(local_path, remote_dir)
+        finally:
+            os.remove(local_path)
+        return os.path.join(remote_dir, name)
+
+    def _remote_checksums(self, remote, remote_studydir, paths):
+        list_path = self._upload_file_list(remote, remote_studydir, paths, ".paramate-checksum.list")
+        output = remote.command("cd %s && tr '\\n' '\\0' < %s | xargs -0 md5sum ; rm -f %s"\
+                                % (remote_studydir, list_path, list_path), fail_on_error=False)
+        hashes = {}
+        for line in output:
+            fields = line.rstrip("\n").split(None, 1)
+            if len(fields) == 2:
+                hashes[os.path.normpath(fields[1])] = fields[0]
+        return hashes
+
+    def download(self, remote, force=False, compress_only=False, incremental=False, checksum=False, shards=1):
+        remote_studydir = os.path.join(remote.workdir, self.study.name)
+        if not remote.remote_dir_exists(remote_studydir):
+            raise Exception("Study '%s' does not exists in remote '%s'." % (self.study.name, remote.name))
+        targets = self._download_targets()
+        compress_dirs = ""
+        list_path = None
+        list_name = ".paramate-download.list"
+        manifest = self._remote_manifest(remote, remote_studydir, targets)
+        if incremental:
+            _printer.print_msg("Comparing remote files with local copies...")
+            changed = self._local_changes(remote, remote_studydir, manifest, checksum)
+            _printer.print_msg("Found %d new or changed files out of %d." % (len(changed), len(manifest)))
+            if not changed:
+                self._set_downloaded(incremental)
+                return
+            archived = changed
+            compress_dirs = "-T %s" % os.path.join(remote_studydir, list_name)
+        else:
+            archived = sorted(manifest.keys())
+            for paths, excludes in targets:
+                for f in excludes:
+                    compress_dirs += " --exclude=%s" % f
+                compress_dirs += " " + " ".join(paths)
 
-        compress_src = os.path.join(remote_studydir, self.study.name + ".tar.gz")
-        tar_cmd = "tar -czf %s %s" % (compress_src, compress_dirs)
+        codec = self._codec(remote)
+        compress_src = os.path.join(remote_studydir, self.study.name + codec.ext)
+        tar_cmd = "tar %s -cf %s %s" % (codec.tar_flags(), compress_src, compress_dirs)
         #TODO: REMOVE THIS
         force = True
-        _printer.print_msg("Compressing study...")
-        try:
-            if force:
-                tar_cmd += " --ignore-failed-read"
-            remote.command("cd %s && %s" % (remote_studydir, tar_cmd) ,\
-                           fail_on_error=False, timeout=60)
-        except Exception as error:
-            if remote.command_status != 0:
-                remote.command("cd %s && rm -f %s" % (remote_studydir, compress_src), timeout=60)
-                raise Exception(error)
+        if force:
+            tar_cmd += " --ignore-failed-read"
+        if shards > 1:
+            self._download_shards(remote, remote_studydir, manifest, archived, codec, shards, force,
+                                  compress_only, incremental)
+            return
+        # An archive left by an interrupted download is reused if the files did not change
+        archive_key = self._archive_key(tar_cmd, [(path, manifest[path]) for path in archived])
+        key_path = compress_src + ARCHIVE_KEY_SUFFIX
+        output = remote.command("[ -f %s ] && cat %s" % (compress_src, key_path), timeout=60, fail_on_error=False)
+        if output and output[0].strip() == archive_key:
+            _printer.print_msg("Remote archive unchanged. Skipping compression...")
+        else:
+            _printer.print_msg("Compressing study...")
+            if incremental:
+                list_path = self._upload_file_list(remote, remote_studydir, changed, list_name)
+            try:
+                remote.command("cd %s && rm -f %s && %s" % (remote_studydir, key_path, tar_cmd) ,\
+                               fail_on_error=False)
+                if remote.command_status == 0:
+                    remote.command("echo %s > %s" % (archive_key, key_path), timeout=60)
+            except Exception as error:
+                if remote.command_status != 0:
+                    remote.command("cd %s && rm -f %s" % (remote_studydir, compress_src), timeout=60)
+                    raise Exception(error)
+            finally:
+                if list_path is not None:
+                    remote.command("rm -f %s" % list_path, timeout=60)
         if not compress_only:
             remote.download(compress_src, self.study.path)
             _printer.print_msg("Decompressing study...")
-            tar_path = os.path.join(self.study.path, self.study.name) + ".tar.gz"
-            self._decompress(tar_path, self.study.path)
-            for case in self.study.case_selection:
-                case.status = "DOWNLOADED"
-            self.study.save()
+            tar_path = os.path.join(self.study.path, self.study.name) + codec.ext
+            self._decompress(tar_path, self.study.path, codec)
+            self._set_downloaded(incremental)
             _printer.print_msg("Cleaning...")
-            remote.command("cd %s && rm -f %s" % (remote_studydir, compress_src), timeout=60)
+            remote.command("cd %s && rm -f %s %s" % (remote_studydir, compress_src, key_path), timeout=60)
+
+    @staticmethod
+    def _archive_key(*parts):
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    # Splits the files in 'shards' groups of similar size. The files of a case stay
+    # in the same group, so archives extracted at once never write to the same directory.
+    @staticmethod
+    def _shard_files(manifest, paths, shards):
+        groups = {}
+        for path in paths:
+            group = groups.setdefault(path.split(os.sep)[0], [0, []])
+            group[0] += manifest[path][0]
+            group[1].append(path)
+        shard_groups = [[0, []] for _ in range(min(shards, len(groups)))]
+        for size, files in sorted(groups.values(), key=lambda group: group[0], reverse=True):
+            shard_group = min(shard_groups, key=lambda shard_group: shard_group[0])
+            shard_group[0] += size
+            shard_group[1].extend(files)
+        return [sorted(files) for size, files in shard_groups if files]
+
+    # The remote compresses one archive per shard at once. Shards are downloaded one
+    # after another and extracted in a pool of threads meanwhile (decompression and
+    # file writes run outside the interpreter lock).
+    def _download_shards(self, remote, remote_studydir, manifest, archived, codec, shards, force,
+                         compress_only, incremental):
+        shard_paths = self._shard_files(manifest, archived, shards)
+        if not shard_paths:
+            _printer.print_msg("No files to download.")
+            if not compress_only:
+                self._set_downloaded(incremental)
+            return
+        sources, cmds, keys, list_paths = [], [], [], []
+        for i, paths in enumerate(shard_paths):
+            compress_src = os.path.join(remote_studydir, "%s.%03d%s" % (self.study.name, i, codec.ext))
+            list_name = ".paramate-download.%03d.list" % i
+            tar_cmd = "tar %s -cf %s -T %s" % (codec.tar_flags(), compress_src, list_name)
+            if force:
+                tar_cmd += " --ignore-failed-read"
+            sources.append(compress_src)
+            keys.append(self._archive_key(tar_cmd, [(path, manifest[path]) for path in paths]))
+            cmds.append(tar_cmd)
+        key_paths = [src + ARCHIVE_KEY_SUFFIX for src in sources]
+        outputs = remote.commands(["[ -f %s ] && cat %s" % (src, key_path) for src, key_path in zip(sources, key_paths)],
+                                  timeout=60)
+        # Archives left by an interrupted download are reused if their files did not change
+        pending = [i for i, (stdout, stderr, status) in enumerate(outputs)
+                   if not (status == 0 and stdout and stdout[0].strip() == keys[i])]
+        if len(pending) < len(sources):
+            _printer.print_msg("Reusing %d unchanged remote archives." % (len(sources) - len(pending)))
+        if pending:
+            _printer.print_msg("Compressing study in %d archives..." % len(pending))
+            try:
+                for i in pending:
+                    list_paths.append(self._upload_file_list(remote, remote_studydir, shard_paths[i],
+                                                             ".paramate-download.%03d.list" % i))
+                results = remote.commands(["cd %s && rm -f %s && %s && echo %s > %s"
+                                           % (remote_studydir, key_paths[i], cmds[i], keys[i], key_paths[i])
+                                           for i in pending])
+            finally:
+                if list_paths:
+                    remote.command("rm -f %s" % " ".join(list_paths), timeout=60)
+            failed = [(i, result) for i, result in zip(pending, results) if result[2] != 0]
+            if failed:
+                remote.command("rm -f %s" % " ".join([sources[i] for i, result in failed]), timeout=60)
+                stdout, stderr, status = failed[0][1]
+                raise CmdExecutionError("".join([l for l in (stderr if stderr else stdout) if l]))
+        if compress_only:
+            return
+        _printer.print_msg("Downloading and decompressing %d archives..." % len(sources))
+        pool = ThreadPool(min(len(sources), multiprocessing.cpu_count()))
+        try:
+            extractions = []
+            for src in sources:
+                remote.download(src, self.study.path)
+                tar_path = os.path.join(self.study.path, os.path.basename(src))
+                extractions.append(pool.apply_async(self._extract_shard, (tar_path, self.study.path, codec)))
+            pool.close()
+            for extraction in extractions:
+                extraction.get()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        self._set_downloaded(incremental)
+        _printer.print_msg("Cleaning...")
+        remote.command("cd %s && rm -f %s %s" % (remote_studydir, " ".join(sources), " ".join(key_paths)), timeout=60)
+
+    def _extract_shard(self, tar_path, dest_path, codec):
+        self._decompress(tar_path, dest_path, codec)
+        os.remove(tar_path)
+
+    # Runs the column functions of 'postproc.py' in the remote, directly or as a job
+    # that waits for the jobs of the cases. Returns the rows of every table, or
+    # None when submitted as a job ('fetch_postproc' retrieves them later).
+    def remote_postproc(self, remote, as_job=False, jobs=1, use_cache=True):
+        remote_studydir = os.path.join(remote.workdir, self.study.name)
+        if not remote.remote_dir_exists(remote_studydir):
+            raise Exception("Study '%s' does not exists in remote '%s'." % (self.study.name, remote.name))
+        postproc_dir = os.path.join(remote_studydir, POSTPROC_DIRNAME)
+        results_path = os.path.join(postproc_dir, POSTPROC_RESULTS)
+        remote.command("mkdir -p %s && rm -f %s" % (postproc_dir, results_path), timeout=60)
+        _printer.print_msg("Uploading postprocessing files...")
+        # The local 'postproc.py' takes precedence over the one in the study
+        for path in (os.path.join(self.study.path, "postproc.py"), os.path.join(SRC_DIR, "postproc_runner.py"),
+                     os.path.join(SRC_DIR, "case.py"), os.path.join(SRC_DIR, "casedata.py")):
+            remote.upload(path, postproc_dir)
+        cases = self.study.case_selection
+        list_path = self._upload_file_list(remote, postproc_dir, [case.name for case in cases], "cases.list")
+        runner_cmd = "%s %s -j %d %s%s %s %s" % (remote.python, os.path.join(postproc_dir, "postproc_runner.py"), jobs,
+                                                 "" if use_cache else "--no-cache ", remote_studydir, results_path, list_path)
+        if not as_job:
+            _printer.print_msg("Postprocessing %d cases in remote..." % len(cases))
+            remote.command(runner_cmd)
+            return self.fetch_postproc(remote)
+        scheduler = get_scheduler(remote)
+        script_path = self._upload_text(remote, postproc_dir, "postproc_job.sh",
+                                        "#!/bin/sh\ncd %s\n%s\n" % (remote_studydir, runner_cmd))
+        active_job_ids = [case.job_id for case in cases if case.status == "SUBMITTED" and case.job_id is not None]
+        if active_job_ids:
+            submit_cmd = scheduler.dependent_submit_command(script_path, active_job_ids)
+        else:
+            submit_cmd = "%s %s" % (scheduler.commands["submit"], script_path)
+        output = remote.command("cd %s && %s" % (postproc_dir, submit_cmd), timeout=60)
+        job_id = self._extract_job_id(output)
+        _printer.print_msg("Submitted postprocessing job '%s' (waiting for %d jobs)." % (job_id, len(active_job_ids)))
+        return None
+
+    def fetch_postproc(self, remote):
+        results_path = os.path.join(remote.workdir, self.study.name, POSTPROC_DIRNAME, POSTPROC_RESULTS)
+        if not remote.remote_file_exists(results_path):
+            raise Exception("Results of the postprocessing not found in remote '%s'. The job may not have finished yet." % remote.name)
+        remote.download(results_path, self.tmpdir)
+        local_path = os.path.join(self.tmpdir, POSTPROC_RESULTS)
+        try:
+            with open(local_path, 'r') as results_file:
+                return json.load(results_file)
+        finally:
+            os.remove(local_path)
+
+    # Incremental downloads may fetch partial results of running jobs, so only
+    # finished or failed cases are marked as downloaded.
+    def _set_downloaded(self, incremental=False):
+        for case in self.study.case_selection:
+            if not incremental or case.status in ("FINISHED", "FAILED"):
+                case.status = "DOWNLOADED"
+        self.study.save()
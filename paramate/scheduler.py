@@ -0,0 +1,416 @@
+import re
+import os
+import sys
+import json
+import pipes
+import xml.etree.ElementTree as ET
+import localqueue
+
+# Job states reported by the schedulers
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+# Not found in the scheduler queue nor in its history
+VANISHED = "vanished"
+ACTIVE_STATES = [QUEUED, RUNNING]
+
+
+def _expand_ranges(ranges_str):
+    # "1-3,7,9-13:2" -> [1, 2, 3, 7, 9, 11, 13]
+    indices = []
+    for part in ranges_str.split(','):
+        match = re.match(r"^(\d+)(?:-(\d+)(?::(\d+))?)?$", part.strip())
+        if match is None:
+            continue
+        first, last, step = match.groups()
+        if last is None:
+            indices.append(int(first))
+        else:
+            indices.extend(range(int(first), int(last) + 1, int(step or 1)))
+    return indices
+
+
+def _finished_state(exit_code):
+    if exit_code is None or exit_code == 0:
+        return COMPLETED
+    return FAILED
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Scheduler(object):
+    DEFAULT_COMMANDS = {"submit": "qsub", "status": "qstat", "delete": "qdel"}
+    ARRAY_INDEX_VAR = None
+    ARRAY_FIRST_INDEX = 0
+    # State column of the plain status output
+    PLAIN_STATES = {}
+
+    def __init__(self, jobs_commands=None):
+        self.commands = dict(self.DEFAULT_COMMANDS)
+        if jobs_commands:
+            self.commands.update(jobs_commands)
+
+    @classmethod
+    def from_remote(cls, remote):
+        return cls(remote.jobs_commands)
+
+    def _unsupported(self, feature):
+        raise Exception("{} not supported by scheduler '{}'.".format(feature, type(self).__name__))
+
+    def array_submit_command(self, script, size):
+        self._unsupported("Array jobs")
+
+    def array_element_id(self, job_id, index):
+        self._unsupported("Array jobs")
+
+    # Submits a job that starts once all the given jobs have finished (whatever their exit status)
+    def dependent_submit_command(self, script, job_ids):
+        self._unsupported("Job dependencies")
+
+    def status_command(self):
+        return self.commands["status"]
+
+    # Ids of the jobs (and array elements) found in a line of the status command output
+    def parse_status_line(self, line):
+        self._unsupported("Status parsing")
+
+    def active_job_ids(self, output):
+        job_ids = set()
+        for line in output:
+            job_ids.update(self.parse_status_line(line))
+        return job_ids
+
+    # Returns {job id: (state, exit code)} for all the given ids with a single status query.
+    def query(self, remote, job_ids):
+        job_ids = set(job_ids)
+        if not job_ids:
+            return {}
+        states = self._query(remote, job_ids)
+        if states is None:
+            states = self._query_plain(remote)
+        return dict([(job_id, states.get(job_id, (VANISHED, None))) for job_id in job_ids])
+
+    # Machine-readable query. Returns None if not supported by the remote.
+    def _query(self, remote, job_ids):
+        return None
+
+    # Only jobs in the queue are listed, so finished jobs are reported as vanished
+    def _query_plain(self, remote):
+        output = remote.command(self.status_command(), timeout=60)
+        states = {}
+        for line in output:
+            line_ids = self.parse_status_line(line)
+            if line_ids:
+                fields = line.split()
+                state = self.PLAIN_STATES.get(fields[4] if len(fields) > 4 else None, RUNNING)
+                for job_id in line_ids:
+                    states[job_id] = (state, None)
+        return states
+
+
+class PBSScheduler(Scheduler):
+    ARRAY_INDEX_VAR = "PBS_ARRAY_INDEX"
+    PLAIN_STATES = {"Q": QUEUED, "H": QUEUED, "W": QUEUED, "T": QUEUED, "S": QUEUED,
+                    "R": RUNNING, "E": RUNNING, "B": RUNNING, "U": RUNNING}
+
+    def array_submit_command(self, script, size):
+        return "%s -J %d-%d %s" % (self.commands["submit"], self.ARRAY_FIRST_INDEX,
+                                   self.ARRAY_FIRST_INDEX + size - 1, script)
+
+    def array_element_id(self, job_id, index):
+        return "%s[%d]" % (job_id, index)
+
+    # Dependencies on array elements are set on the whole array
+    def dependent_submit_command(self, script, job_ids):
+        parent_ids = sorted(set([re.sub(r"\[\d+\]$", "[]", job_id) for job_id in job_ids]))
+        return "%s -W depend=afterany:%s %s" % (self.commands["submit"], ":".join(parent_ids), script)
+
+    # Show array subjobs
+    def status_command(self):
+        return "%s -t" % self.commands["status"]
+
+    def parse_status_line(self, line):
+        match = re.match(r"^\s*(\d+)(\[\d*\])?", line)
+        if match is None:
+            return []
+        job_id, element = match.groups()
+        if element in (None, "[]"):
+            return [job_id]
+        return [job_id + element]
+
+    # Array elements are queried through their parent 'id[]'
+    def _query_ids(self, job_ids):
+        query_ids = set()
+        for job_id in job_ids:
+            match = re.match(r"^(\d+)\[\d+\]$", job_id)
+            query_ids.add(match.group(1) + "[]" if match is not None else job_id)
+        return " ".join([pipes.quote(job_id) for job_id in sorted(query_ids)])
+
+    def _state(self, state_letter, exit_code):
+        # 'F' (PBS Pro history), 'X' (finished subjob) and 'C' (Torque completed)
+        if state_letter in ("F", "X", "C"):
+            return (_finished_state(exit_code), exit_code)
+        return (self.PLAIN_STATES.get(state_letter, RUNNING), exit_code)
+
+    # PBS Pro 'qstat -f -F json -x' (with finished jobs), then Torque 'qstat -x' (XML)
+    def _query(self, remote, job_ids):
+        query_ids = self._query_ids(job_ids)
+        output = remote.command("%s -f -F json -x -t %s" % (self.commands["status"], query_ids),
+                                timeout=60, fail_on_error=False)
+        if output:
+            try:
+                return self._parse_json("".join(output))
+            except ValueError:
+                pass
+        output = remote.command("%s -x -t %s" % (self.commands["status"], query_ids),
+                                timeout=60, fail_on_error=False)
+        if output:
+            try:
+                return self._parse_xml("".join(output))
+            except ET.ParseError:
+                pass
+        return None
+
+    def _parse_json(self, text):
+        states = {}
+        for full_id, job in json.loads(text).get("Jobs", {}).items():
+            job_id = full_id.split(".")[0]
+            states[job_id] = self._state(job.get("job_state"), _to_int(job.get("Exit_status")))
+        return states
+
+    def _parse_xml(self, text):
+        states = {}
+        for job in ET.fromstring(text).iter("Job"):
+            job_id = job.findtext("Job_Id", "").split(".")[0]
+            states[job_id] = self._state(job.findtext("job_state"), _to_int(job.findtext("exit_status")))
+        return states
+
+
+class SGEScheduler(Scheduler):
+    ARRAY_INDEX_VAR = "SGE_TASK_ID"
+    ARRAY_FIRST_INDEX = 1
+    PLAIN_STATES = {"qw": QUEUED, "hqw": QUEUED, "hRwq": QUEUED, "Eqw": FAILED,
+                    "r": RUNNING, "t": RUNNING, "Rr": RUNNING, "s": RUNNING, "S": RUNNING}
+
+    def array_submit_command(self, script, size):
+        return "%s -t %d-%d %s" % (self.commands["submit"], self.ARRAY_FIRST_INDEX,
+                                   self.ARRAY_FIRST_INDEX + size - 1, script)
+
+    def array_element_id(self, job_id, index):
+        return "%s.%d" % (job_id, index)
+
+    def dependent_submit_command(self, script, job_ids):
+        parent_ids = sorted(set([job_id.split(".")[0] for job_id in job_ids]))
+        return "%s -hold_jid %s %s" % (self.commands["submit"], ",".join(parent_ids), script)
+
+    # Array tasks are listed in the last column (ja-task-ID), pending ones as ranges.
+    # Pending jobs have no queue column.
+    def parse_status_line(self, line):
+        fields = line.split()
+        if len(fields) < 5 or re.match(r"^\d+$", fields[0]) is None:
+            return []
+        job_id = fields[0]
+        nof_fields = 9 if "q" in fields[4] else 10
+        if len(fields) >= nof_fields and re.match(r"^[\d,:-]+$", fields[-1]):
+            return [self.array_element_id(job_id, i) for i in _expand_ranges(fields[-1])]
+        return [job_id]
+
+    def _state(self, state):
+        if "E" in state:
+            return FAILED
+        elif "q" in state:
+            return QUEUED
+        return RUNNING
+
+    # Jobs in the queue from 'qstat -xml', finished ones from the accounting file
+    def _query(self, remote, job_ids):
+        output = remote.command("%s -xml -u $USER" % self.commands["status"], timeout=60, fail_on_error=False)
+        if remote.command_status != 0:
+            return None
+        try:
+            states = self._parse_xml("".join(output))
+        except ET.ParseError:
+            return None
+        missing_ids = set([job_id.split(".")[0] for job_id in job_ids if job_id not in states])
+        if missing_ids:
+            # Each 'qacct' call scans the whole accounting file, so all the jobs of the
+            # user are listed at once (only the fields used) and filtered here
+            output = remote.command("qacct -o $USER -j '*' | grep -E '^(=|jobnumber|taskid|failed|exit_status)'",
+                                    timeout=60, fail_on_error=False)
+            for job_id, state in self._parse_qacct(output).items():
+                if job_id.split(".")[0] in missing_ids and job_id not in states:
+                    states[job_id] = state
+        return states
+
+    def _parse_xml(self, text):
+        states = {}
+        for job in ET.fromstring(text).iter("job_list"):
+            job_id = job.findtext("JB_job_number")
+            state = self._state(job.findtext("state", ""))
+            tasks = job.findtext("tasks")
+            if tasks:
+                for i in _expand_ranges(tasks):
+                    states[self.array_element_id(job_id, i)] = (state, None)
+            else:
+                states[job_id] = (state, None)
+        return states
+
+    def _parse_qacct(self, output):
+        states = {}
+        record = {}
+        # Records are separated by '====...' lines
+        for line in output + ["="]:
+            if line.startswith("="):
+                if "jobnumber" in record:
+                    job_id = record["jobnumber"]
+                    if _to_int(record.get("taskid")) is not None:
+                        job_id = self.array_element_id(job_id, int(record["taskid"]))
+                    exit_code = _to_int(record.get("exit_status"))
+                    if record.get("failed", "0").split()[0] != "0":
+                        states[job_id] = (FAILED, exit_code)
+                    else:
+                        states[job_id] = (_finished_state(exit_code), exit_code)
+                record = {}
+                continue
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                record[fields[0]] = fields[1].strip()
+        return states
+
+
+class SlurmScheduler(Scheduler):
+    DEFAULT_COMMANDS = {"submit": "sbatch", "status": "squeue", "delete": "scancel", "accounting": "sacct"}
+    ARRAY_INDEX_VAR = "SLURM_ARRAY_TASK_ID"
+    PLAIN_STATES = {"PD": QUEUED, "S": QUEUED, "R": RUNNING, "CG": RUNNING, "CF": RUNNING}
+    STATES = {"PENDING": QUEUED, "REQUEUED": QUEUED, "SUSPENDED": QUEUED, "RESIZING": QUEUED,
+              "RUNNING": RUNNING, "COMPLETING": RUNNING, "CONFIGURING": RUNNING,
+              "COMPLETED": COMPLETED}
+
+    def array_submit_command(self, script, size):
+        return "%s --array=%d-%d %s" % (self.commands["submit"], self.ARRAY_FIRST_INDEX,
+                                        self.ARRAY_FIRST_INDEX + size - 1, script)
+
+    def array_element_id(self, job_id, index):
+        return "%s_%d" % (job_id, index)
+
+    def dependent_submit_command(self, script, job_ids):
+        parent_ids = sorted(set([job_id.split("_")[0] for job_id in job_ids]))
+        return "%s --dependency=afterany:%s %s" % (self.commands["submit"], ":".join(parent_ids), script)
+
+    # Default format truncates the job id column
+    def status_command(self):
+        return "%s -o '%%i %%P %%j %%u %%t %%M %%D %%R'" % self.commands["status"]
+
+    # Pending elements are grouped as '1234_[5-9,12]'
+    def parse_status_line(self, line):
+        match = re.match(r"^\s*(\d+)(?:_(\d+|\[[^\]]*\]))?", line)
+        if match is None:
+            return []
+        job_id, element = match.groups()
+        if element is None:
+            return [job_id]
+        if element.startswith("["):
+            return [self.array_element_id(job_id, i) for i in _expand_ranges(element.strip("[]").split('%')[0])]
+        return [self.array_element_id(job_id, int(element))]
+
+    # 'sacct' covers queued, running and finished jobs. 'squeue' is used when
+    # accounting is not enabled.
+    def _query(self, remote, job_ids):
+        query_ids = ",".join(sorted(set([job_id.split("_")[0] for job_id in job_ids])))
+        output = remote.command("%s -X -n -P -o JobID,State,ExitCode -j %s" % (self.commands["accounting"], query_ids),
+                                timeout=60, fail_on_error=False)
+        if remote.command_status == 0:
+            return self._parse_parsable(output)
+        output = remote.command("%s -h -o '%%i|%%T|' -j %s" % (self.commands["status"], query_ids),
+                                timeout=60, fail_on_error=False)
+        if remote.command_status == 0:
+            return self._parse_parsable(output)
+        return None
+
+    def _parse_parsable(self, output):
+        states = {}
+        for line in output:
+            fields = line.strip().split("|")
+            if len(fields) < 3:
+                continue
+            job_state = fields[1].split()[0] if fields[1] else ""
+            exit_code = None
+            if fields[2]:
+                exit_code, signal = [_to_int(v) for v in (fields[2].split(":") + ["0"])[:2]]
+                if signal:
+                    exit_code = exit_code or 128 + signal
+            if job_state in self.STATES:
+                state = self.STATES[job_state]
+            else:
+                state = FAILED
+            for job_id in self.parse_status_line(fields[0]):
+                states[job_id] = (state, exit_code)
+        return states
+
+
+class LocalScheduler(Scheduler):
+    ARRAY_INDEX_VAR = localqueue.ARRAY_INDEX_VAR
+    PLAIN_STATES = {localqueue.QUEUED: QUEUED, localqueue.RUNNING: RUNNING}
+
+    def __init__(self, queue_dir, resources=None):
+        self.queue_dir = queue_dir
+        queue_cmd = "%s %s -d %s" % (sys.executable, localqueue.LOCAL_SCRIPT, pipes.quote(queue_dir))
+        submit_cmd = queue_cmd + " submit"
+        for name in ("cpus", "memory", "max-jobs"):
+            if resources and name in resources:
+                submit_cmd += " --%s %d" % (name, resources[name])
+        super(LocalScheduler, self).__init__({"submit": submit_cmd,
+                                              "status": queue_cmd + " status",
+                                              "delete": queue_cmd + " delete"})
+
+    @classmethod
+    def from_remote(cls, remote):
+        return cls(os.path.join(remote.workdir, localqueue.QUEUE_DIRNAME), remote.local_resources)
+
+    def array_submit_command(self, script, size):
+        return "%s -J %d-%d %s" % (self.commands["submit"], self.ARRAY_FIRST_INDEX,
+                                   self.ARRAY_FIRST_INDEX + size - 1, script)
+
+    def array_element_id(self, job_id, index):
+        return "%s[%d]" % (job_id, index)
+
+    def dependent_submit_command(self, script, job_ids):
+        return "%s --after %s %s" % (self.commands["submit"], ",".join(sorted(job_ids)), script)
+
+    def parse_status_line(self, line):
+        match = re.match(r"^(\d+(?:\[\d+\])?)\s", line)
+        if match is None:
+            return []
+        return [match.group(1)]
+
+    # The job table is on this machine, so it is read directly
+    def _query(self, remote, job_ids):
+        jobs = localqueue.LocalQueue(self.queue_dir).jobs()
+        states = {}
+        for job_id in job_ids:
+            if job_id in jobs:
+                job = jobs[job_id]
+                if job["state"] in self.PLAIN_STATES:
+                    states[job_id] = (self.PLAIN_STATES[job["state"]], None)
+                elif job["state"] == localqueue.COMPLETED:
+                    states[job_id] = (COMPLETED, job["exit-code"])
+                else:
+                    states[job_id] = (FAILED, job["exit-code"])
+        return states
+
+
+SCHEDULERS = {"pbs": PBSScheduler, "sge": SGEScheduler, "slurm": SlurmScheduler, "local": LocalScheduler}
+
+
+def get_scheduler(remote):
+    try:
+        scheduler_class = SCHEDULERS[remote.resource_manager]
+    except KeyError:
+        raise Exception("Resource manager '{}' of remote '{}' not supported.".format(remote.resource_manager, remote.name))
+    return scheduler_class.from_remote(remote)
@@ -26,6 +26,7 @@ class Study:
         self.case_selection = []
         self.nof_cases = 0
 
+    # Groups for every combination of the values found, including the empty ones
     def group_by_param(self, case_list, params):
         param_vals = []
         for p in params:
@@ -37,16 +38,15 @@ class Study:
         pairs = itertools.product(*param_vals)
         groups = {tuple(p): [] for p in pairs}
         for case in case_list:
-            for gk in groups.keys():
-                belong = True
-                for i, p in enumerate(params):
-                    if gk[i] != case.params[p]:
-                        belong = False
-                        break
-                if belong:
-                    groups[gk].append(case)
+            groups[tuple([case.params[p] for p in params])].append(case)
         return groups
 
+    # Reduces a results table over the cases with equal values of the 'group_by'
+    # columns. See 'postprocessing.aggregate_table'.
+    def aggregate(self, data_frame, group_by, reductions, columns=None):
+        from postprocessing import aggregate_table
+        return aggregate_table(data_frame, group_by, reductions, columns)
+
              
     def sort_by_param(self, case_list_in, param):
         case_list = list(case_list_in)
@@ -115,6 +115,20 @@ class Study:
     def save(self):
         self.study_file.save(self.cases, self.params)
 
+    # Writes the job states of the given cases on top of the current 'cases.info',
+    # only for cases still submitted with the same job, so changes made meanwhile
+    # by other commands (download, job submit...) are kept.
+    def save_job_states(self, cases):
+        with self.study_file.lock():
+            study_data = self.study_file.load()
+            saved_cases = dict([(case.name, case) for case in study_data["cases"]])
+            for case in cases:
+                saved_case = saved_cases.get(case.name)
+                if saved_case is not None and saved_case.status == "SUBMITTED" and saved_case.job_id == case.job_id:
+                    saved_case.job_state, saved_case.exit_code = case.job_state, case.exit_code
+                    saved_case.status = case.status
+            self.study_file.save(study_data["cases"], study_data["params"])
+
     # TODO: Convert into reset
     def clean(self, selection_on=True):
         if selection_on:
@@ -274,11 +288,18 @@ class StudyGenerator(Study):
 
 
     #TODO: Decouple state and behaviour of instances into a new class
-    def generate_cases(self, local_remote=None):
+    # Only the cases in 'case_ids' are created if given. The rest are still added to the
+    # study, so ids and generated values are the same as in a complete generation.
+    def generate_cases(self, local_remote=None, case_ids=None):
         self._generate_instances()
         # Check if build.sh has to be run before generating the instances
         nof_instances = len(self.instances)
-        _printer.print_msg("Generating {} cases...".format(nof_instances))
+        if case_ids is not None:
+            case_ids = set(case_ids)
+            nof_created = len(case_ids.intersection(range(nof_instances)))
+        else:
+            nof_created = nof_instances
+        _printer.print_msg("Generating {} cases...".format(nof_created))
         if not os.path.exists(self.template_path):
             raise Exception("Cannot find 'template' directory!")
         if os.path.exists(self.build_script_path):
@@ -298,12 +319,16 @@ class StudyGenerator(Study):
             singleval_params = self._get_singleval_params(instance)
             instance_name = self._instance_directory_string(instance_id, multival_params,
                                                       nof_instances, self.short_name)
+            if case_ids is not None and instance_id not in case_ids:
+                self.study.add_case(instance_name, multival_params, singleval_params,
+                                    short_name=self.short_name)
+                continue
             self._create_instance(instance_name, instance, local_remote=local_remote)
             self.study.add_case(instance_name, multival_params, singleval_params,
                                 short_name=self.short_name, local_remote=local_remote)
 
         self.study.save()
-        _printer.print_msg("Success: Created %d cases." % nof_instances)
+        _printer.print_msg("Success: Created %d cases." % nof_created)
 
     def _generate_instances(self):
         instance = ParamInstance()
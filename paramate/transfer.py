@@ -0,0 +1,289 @@
+import os
+import stat
+import json
+import hashlib
+import pipes
+import threading
+import Queue
+
+# Content-addressed store shared by all the studies uploaded to the same remote workdir
+STORE_DIRNAME = ".paramate-store"
+LINKS_SCRIPT_NAME = ".paramate-links.sh"
+# Progress record kept next to the local file of a resumable transfer
+RECORD_SUFFIX = ".paramate-part"
+
+
+def file_digest(path, blocksize=1024*1024, algorithm="sha1"):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_key(path):
+    # Permissions are part of the key as hardlinked files share the inode
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    return "%s.%o" % (file_digest(path), mode)
+
+
+class ContentIndex:
+    def __init__(self, base_path):
+        self.base_path = base_path
+        # (key, relative path) for every regular file
+        self.files = []
+        # Relative paths of directories and of entries that cannot be hardlinked (symlinks...)
+        self.dirs = []
+        self.others = []
+        # First local file found for each key
+        self.sources = {}
+
+    def add(self, rel_path):
+        abs_path = os.path.join(self.base_path, rel_path)
+        if os.path.isdir(abs_path) and not os.path.islink(abs_path):
+            self.dirs.append(rel_path)
+            for root, dirnames, filenames in os.walk(abs_path):
+                rel_root = os.path.relpath(root, self.base_path)
+                for d in sorted(dirnames):
+                    d_path = os.path.join(rel_root, d)
+                    if os.path.islink(os.path.join(root, d)):
+                        self.others.append(d_path)
+                    else:
+                        self.dirs.append(d_path)
+                for f in sorted(filenames):
+                    self._add_file(os.path.join(rel_root, f))
+        else:
+            self._add_file(rel_path)
+
+    def _add_file(self, rel_path):
+        abs_path = os.path.join(self.base_path, rel_path)
+        if os.path.islink(abs_path) or not os.path.isfile(abs_path):
+            self.others.append(rel_path)
+            return
+        key = content_key(abs_path)
+        self.files.append((key, rel_path))
+        self.sources.setdefault(key, abs_path)
+
+    def keys(self):
+        return set(self.sources.keys())
+
+    # Store entries are made read-only. Read-only files are hardlinked from the store,
+    # writable ones are copied (shared blocks where the filesystem supports reflinks),
+    # so a job writing into its inputs does not change the store or other cases.
+    def links_script(self, prefix):
+        lines = ["#!/bin/sh", "set -e"]
+        for key in sorted(self.keys()):
+            lines.append("chmod a-w %s" % os.path.join(STORE_DIRNAME, key))
+        for key, rel_path in self.files:
+            src = os.path.join(STORE_DIRNAME, key)
+            dest = pipes.quote(os.path.join(prefix, rel_path))
+            mode = int(key.rsplit(".", 1)[1], 8)
+            if mode & 0o222:
+                # Removed first, as it may be a hardlink into the store
+                lines.append("rm -f %s && cp --reflink=auto %s %s && chmod %o %s" % (dest, src, dest, mode, dest))
+            else:
+                lines.append("ln -f %s %s" % (src, dest))
+        return "\n".join(lines) + "\n"
+
+
+# Segments (chunks) of a transfer already completed, with their sha1. Only valid
+# while the source file and the chunk size do not change.
+class SegmentRecord:
+    def __init__(self, path, identity):
+        self.path = path
+        self.identity = identity
+        self.segments = {}
+        try:
+            with open(path, 'r') as record_file:
+                data = json.load(record_file)
+        except (IOError, ValueError):
+            return
+        if data.get("identity") == identity:
+            self.segments = dict([(int(offset), digest) for offset, digest in data["segments"].items()])
+
+    def done(self, offset):
+        return offset in self.segments
+
+    def add(self, offset, digest):
+        self.segments[offset] = digest
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as record_file:
+            json.dump({"identity": self.identity, "segments": self.segments}, record_file)
+        os.rename(tmp_path, self.path)
+
+    def reset(self):
+        self.segments = {}
+        self.remove()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # Drops the segments whose local data does not match the recorded digest
+    def verify_local(self, local_path, chunk_size):
+        with open(local_path, 'rb') as local_file:
+            for offset, digest in self.segments.items():
+                local_file.seek(offset)
+                if hashlib.sha1(local_file.read(chunk_size)).hexdigest() != digest:
+                    del self.segments[offset]
+
+
+class TransferEngine:
+    def __init__(self, transports, streams=4, chunk_size=64*1024*1024, progress_callback=None, resume=False):
+        self.transports = transports
+        self.streams = max(1, streams)
+        self.chunk_size = chunk_size
+        self.block_size = 1024*1024
+        self.progress_callback = progress_callback
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._total = 0
+        self._sent = 0
+        self._label = ""
+
+    # Files are lists of (source, destination) paths
+    def download(self, files):
+        sftp = self.transports[0].open_sftp_client()
+        try:
+            stats = [sftp.stat(src) for src, dest in files]
+        finally:
+            sftp.close()
+        sizes = [st.st_size for st in stats]
+        records = []
+        for (src, dest), st in zip(files, stats):
+            record = self._record(dest, [src, st.st_size, int(st.st_mtime)])
+            if record is not None and record.segments and os.path.isfile(dest) and os.path.getsize(dest) == st.st_size:
+                record.verify_local(dest, self.chunk_size)
+            else:
+                if record is not None:
+                    record.reset()
+                with open(dest, 'wb') as f:
+                    f.truncate(st.st_size)
+            records.append(record)
+        self._run(files, sizes, self._download_chunk, records)
+
+    def upload(self, files):
+        stats = [os.stat(src) for src, dest in files]
+        sizes = [st.st_size for st in stats]
+        records = [self._record(src, [dest, st.st_size, int(st.st_mtime)]) for (src, dest), st in zip(files, stats)]
+        sftp = self.transports[0].open_sftp_client()
+        try:
+            for (src, dest), size, record in zip(files, sizes, records):
+                if record is not None and record.segments:
+                    try:
+                        if sftp.stat(dest).st_size == size:
+                            continue
+                    except IOError:
+                        pass
+                    record.reset()
+                sftp.open(dest, 'wb').close()
+                sftp.truncate(dest, size)
+        finally:
+            sftp.close()
+        self._run(files, sizes, self._upload_chunk, records)
+
+    def _record(self, local_path, identity):
+        if not self.resume:
+            return None
+        return SegmentRecord(local_path + RECORD_SUFFIX, identity + [self.chunk_size])
+
+    def _run(self, files, sizes, chunk_func, records):
+        chunks = Queue.Queue()
+        self._sent = 0
+        for (src, dest), size, record in zip(files, sizes, records):
+            for offset in range(0, max(size, 1), self.chunk_size):
+                length = min(self.chunk_size, size - offset)
+                if record is not None and record.done(offset):
+                    self._sent += length
+                    continue
+                chunks.put((src, dest, offset, length, record))
+        self._total = sum(sizes)
+        if len(files) == 1:
+            self._label = os.path.basename(files[0][0])
+        else:
+            self._label = "%d files" % len(files)
+        errors = []
+        nof_workers = min(self.streams, chunks.qsize())
+        if self._sent and self.progress_callback is not None:
+            self.progress_callback(self._label, self._total, self._sent)
+        workers = []
+        for i in range(nof_workers):
+            transport = self.transports[i % len(self.transports)]
+            worker = threading.Thread(target=self._worker, args=(transport, chunks, chunk_func, errors))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        for record in records:
+            if record is not None:
+                record.remove()
+
+    def _worker(self, transport, chunks, chunk_func, errors):
+        try:
+            sftp = transport.open_sftp_client()
+        except Exception as error:
+            errors.append(error)
+            return
+        try:
+            while not errors:
+                try:
+                    src, dest, offset, length, record = chunks.get_nowait()
+                except Queue.Empty:
+                    break
+                digest = chunk_func(sftp, src, dest, offset, length)
+                if record is not None:
+                    with self._lock:
+                        record.add(offset, digest)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            sftp.close()
+
+    def _blocks(self, offset, length):
+        return [(o, min(self.block_size, offset + length - o))
+                for o in range(offset, offset + length, self.block_size)]
+
+    # Chunk functions return the sha1 of the data transferred
+    def _download_chunk(self, sftp, src, dest, offset, length):
+        digest = hashlib.sha1()
+        if length <= 0:
+            return digest.hexdigest()
+        remote_file = sftp.open(src, 'rb')
+        try:
+            with open(dest, 'r+b') as local_file:
+                local_file.seek(offset)
+                for data in remote_file.readv(self._blocks(offset, length)):
+                    local_file.write(data)
+                    digest.update(data)
+                    self._update(len(data))
+        finally:
+            remote_file.close()
+        return digest.hexdigest()
+
+    def _upload_chunk(self, sftp, src, dest, offset, length):
+        digest = hashlib.sha1()
+        if length <= 0:
+            return digest.hexdigest()
+        remote_file = sftp.open(dest, 'r+')
+        try:
+            remote_file.set_pipelined(True)
+            remote_file.seek(offset)
+            with open(src, 'rb') as local_file:
+                local_file.seek(offset)
+                for block_offset, block_length in self._blocks(offset, length):
+                    data = local_file.read(block_length)
+                    remote_file.write(data)
+                    digest.update(data)
+                    self._update(len(data))
+        finally:
+            remote_file.close()
+        return digest.hexdigest()
+
+    def _update(self, nbytes):
+        with self._lock:
+            self._sent += nbytes
+            if self.progress_callback is not None:
+                self.progress_callback(self._label, self._total, self._sent)
@@ -0,0 +1,54 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "paramate"))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), "benchmarks"))
+
+import remote
+from common import _printer
+from remote_actions import create_study, STUDY_NAME, REMOTE_NAME
+
+
+class ShardedDownloadTest(unittest.TestCase):
+    def setUp(self):
+        _printer.configure(verbose=False, quiet=True)
+        self.tmpdir = tempfile.mkdtemp(prefix="paramate-test-")
+        self.study = create_study(self.tmpdir, 3, 16)
+        workdir = os.path.join(self.tmpdir, "remote")
+        for case in self.study.cases:
+            os.makedirs(os.path.join(workdir, STUDY_NAME, case.name))
+            case.status = "FINISHED"
+        self.study.save()
+        self.remote = remote.LocalRemote(name=REMOTE_NAME, workdir=workdir, resource_manager="local")
+        self.remote.connect()
+        self.study_manager = remote.StudyManager(self.study)
+        self.study_manager.tmpdir = self.tmpdir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shards_empty_manifest(self):
+        self.study_manager.download(self.remote, shards=3)
+        self.assertEqual([case.status for case in self.study.cases], ["DOWNLOADED"] * 3)
+        self.assertEqual([f for f in os.listdir(os.path.join(self.remote.workdir, STUDY_NAME))
+                          if f.startswith(STUDY_NAME)], [])
+
+    def test_shards(self):
+        for case in self.study.cases:
+            output_dir = os.path.join(self.remote.workdir, STUDY_NAME, case.name, "output")
+            os.makedirs(output_dir)
+            with open(os.path.join(output_dir, "remote.txt"), 'w') as output_file:
+                output_file.write(case.name)
+        self.study_manager.download(self.remote, shards=2)
+        for case in self.study.cases:
+            with open(os.path.join(self.study.path, case.name, "output", "remote.txt"), 'r') as output_file:
+                self.assertEqual(output_file.read(), case.name)
+        self.assertEqual([case.status for case in self.study.cases], ["DOWNLOADED"] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()